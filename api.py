@@ -0,0 +1,294 @@
+"""JSON API for Warbler.
+
+Read endpoints for the feed, profiles, follow lists and likes, for clients
+that want data rather than pages. Queries select just the columns each
+response needs (no ORM objects, no templates), and responses are encoded
+with orjson when it's installed, else the standard library.
+
+Lists are keyset-paginated like the HTML pages: pass the response's
+`next_cursor` back as `before` (messages) or `after` (users and search
+results) for the next page; it's null on the last one.
+
+Every endpoint needs a logged-in session and answers errors as JSON
+{"error": "..."}.
+"""
+
+import json
+
+from flask import Blueprint, current_app, g, request
+from werkzeug.exceptions import HTTPException, NotFound
+
+from models import (
+    db, User, Message, MessageSearch, Follow, FollowSuggestion, Like,
+    SUGGESTIONS_KEPT)
+from pagination import (
+    Page, decode_date, decode_message_cursor, decode_search_cursor,
+    decode_user_cursor, in_order, paginate_messages, paginate_users)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TYPEAHEAD_LIMIT = 10
+
+# what the API shows of messages and users, and the columns it comes from
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+USER_CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
+USER_PROFILE_COLUMNS = (
+    *USER_CARD_COLUMNS,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+
+def dumps(data):
+    """Encode `data` as JSON bytes; datetimes become ISO 8601 strings."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(
+        data, separators=(",", ":"), default=lambda value: value.isoformat(),
+    ).encode()
+
+
+def json_response(data, status=200):
+    """Response with `data` encoded by `dumps`."""
+
+    return current_app.response_class(
+        dumps(data), status=status, mimetype='application/json')
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    """Report HTTP errors as JSON rather than HTML pages."""
+
+    return json_response(dict(error=error.description), error.code)
+
+
+@api.before_request
+def require_login():
+    if not g.user:
+        return json_response(dict(error="Access unauthorized."), 401)
+
+
+def message_query():
+    """Query for MESSAGE_COLUMNS: each message with its author's name and
+    picture, leaving out deleted authors'."""
+
+    # spelled out: the ORM's deleted-user criteria don't reach column-only
+    # queries like this one
+    return (db.session.query(*MESSAGE_COLUMNS)
+            .select_from(Message)
+            .join(User, User.id == Message.user_id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def messages_json(page):
+    """JSON body for a Page of MESSAGE_COLUMNS rows, with whether the
+    viewer likes each one."""
+
+    liked_ids = g.user.liked_ids_among([row.id for row in page.items])
+
+    return dict(
+        messages=[
+            dict(
+                id=row.id,
+                text=row.text,
+                timestamp=row.timestamp,
+                user=dict(
+                    id=row.user_id,
+                    username=row.username,
+                    image_url=row.image_url),
+                liked=row.id in liked_ids,
+            )
+            for row in page.items
+        ],
+        next_cursor=page.next_cursor,
+    )
+
+
+def users_json(page):
+    """JSON body for a Page of user rows, with whether the viewer follows
+    each one."""
+
+    following_ids = g.user.following_ids_among([row.id for row in page.items])
+
+    return dict(
+        users=[
+            dict(row._asdict(), following=row.id in following_ids)
+            for row in page.items
+        ],
+        next_cursor=page.next_cursor,
+    )
+
+
+def require_user(user_id):
+    """Check user `user_id` exists (and isn't deleted), without loading
+    it."""
+
+    exists = db.exists().where(User.id == user_id, User.deleted_at.is_(None))
+
+    if not db.session.scalar(db.select(exists)):
+        raise NotFound("User not found.")
+
+
+@api.get('/feed')
+def feed():
+    """The logged-in user's home feed, newest first."""
+
+    before = decode_message_cursor(request.args.get('before'))
+
+    return json_response(messages_json(
+        Message.feed_page(message_query(), g.user.id, before)))
+
+
+@api.get('/messages/search')
+def search_messages():
+    """Messages matching the 'q' param, best matches first; filtered
+    like the search page by 'author', 'since' and 'until'."""
+
+    page = MessageSearch.search(
+        request.args.get('q', ''),
+        author=request.args.get('author', ''),
+        since=decode_date(request.args.get('since')),
+        until=decode_date(request.args.get('until')),
+        after=decode_search_cursor(request.args.get('after')))
+
+    rows = message_query().filter(Message.id.in_(page.items)).all()
+
+    return json_response(messages_json(
+        Page(in_order(rows, page.items), page.next_cursor)))
+
+
+@api.get('/users/search')
+def search_users():
+    """Typeahead for the search box: users whose username starts with the
+    'q' param.
+
+    Returns {"users": [{id, username, image_url}, ...]}.
+    """
+
+    search = request.args.get('q', '').strip()
+    users = User.search(search, limit=TYPEAHEAD_LIMIT) if search else []
+
+    return json_response(dict(users=[
+        dict(id=user.id, username=user.username, image_url=user.image_url)
+        for user in users
+    ]))
+
+
+@api.get('/users/suggestions')
+def suggested_users():
+    """Who to follow: accounts followed by the users the logged-in user
+    follows, most of them first.
+
+    Returns {"users": [{id, username, ..., mutuals}, ...]}, where
+    `mutuals` is how many of the user's follows follow that account.
+    """
+
+    rows = FollowSuggestion.top(
+        db.session.query(*USER_CARD_COLUMNS), g.user.id, SUGGESTIONS_KEPT)
+
+    return json_response(dict(users=[row._asdict() for row in rows]))
+
+
+@api.get('/users/<int:user_id>')
+def user_profile(user_id):
+    """A user's profile and counters."""
+
+    row = (db.session.query(*USER_PROFILE_COLUMNS)
+           .filter(User.id == user_id)
+           .one_or_none())
+
+    if row is None:
+        raise NotFound("User not found.")
+
+    return json_response(dict(
+        user=dict(
+            row._asdict(),
+            following=bool(g.user.following_ids_among([user_id])),
+        )))
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    require_user(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    return json_response(messages_json(paginate_messages(
+        message_query().filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        before)))
+
+
+@api.get('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows, in id order."""
+
+    require_user(user_id)
+    after = decode_user_cursor(request.args.get('after'))
+
+    return json_response(users_json(paginate_users(
+        db.session.query(*USER_CARD_COLUMNS)
+        .join(Follow, Follow.user_being_followed_id == User.id)
+        .filter(Follow.user_following_id == user_id,
+                User.deleted_at.is_(None)),
+        User.id,
+        after)))
+
+
+@api.get('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """This user's followers, in id order."""
+
+    require_user(user_id)
+    after = decode_user_cursor(request.args.get('after'))
+
+    return json_response(users_json(paginate_users(
+        db.session.query(*USER_CARD_COLUMNS)
+        .join(Follow, Follow.user_following_id == User.id)
+        .filter(Follow.user_being_followed_id == user_id,
+                User.deleted_at.is_(None)),
+        User.id,
+        after)))
+
+
+@api.get('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages this user liked, newest first."""
+
+    require_user(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    return json_response(messages_json(paginate_messages(
+        message_query()
+        .join(Like, Like.message_id == Message.id)
+        .filter(Like.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        before)))
@@ -1,12 +1,33 @@
 import os
+
+import click
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm
-from models import db, connect_db, User, Message
+from models import (
+    db, connect_db, User, Message, MessageSearch, Follow, FollowSuggestion,
+    Like, TimelineEntry, DeletionJob, include_in_migrations,
+    REBUILD_BATCH_SIZE, SUGGESTIONS_SHOWN)
+import querystats
+from api import api
+from assets import assets
+from caching import LRUCache
+from conditional import Validators, render_conditional
+from deletion import deletion_worker
+from fragments import fragment_cache
+from hashing import password_hasher
+from images import image_proxy
+from replicas import replica_router
+from writebehind import write_behind
+from pagination import (
+    Page, decode_date, decode_message_cursor, decode_search_cursor,
+    decode_user_cursor, in_order, paginate_messages, paginate_users)
 from werkzeug.exceptions import Unauthorized
 
 load_dotenv()
@@ -15,16 +36,99 @@ CURR_USER_KEY = "curr_user"
 
 app = Flask(__name__)
 
+
+class WarblerGlobals(app.app_ctx_globals_class):
+    """Flask `g` that loads the logged-in user on first use of `g.user`.
+
+    Requests that never touch `g.user` (static files, redirects) skip the
+    lookup entirely.
+    """
+
+    def __getattr__(self, name):
+        if name == 'user':
+            self.user = load_current_user()
+            return self.user
+
+        return super().__getattr__(name)
+
+
+app.app_ctx_globals_class = WarblerGlobals
+
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     "DATABASE_URL")
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+    pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+    pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    # sizing only applies to queue pools, so it's left to SQLAlchemy's
+    # defaults unless set
+    **{
+        option: int(os.environ[env])
+        for option, env in [
+            ('pool_size', "DB_POOL_SIZE"),
+            ('max_overflow', "DB_MAX_OVERFLOW"),
+            ('pool_timeout', "DB_POOL_TIMEOUT"),
+        ]
+        if env in os.environ
+    })
+app.config['DATABASE_REPLICA_URLS'] = [
+    url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+    if url]
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get(
+    "REPLICA_STICKY_SECONDS", 5))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ["SECRET_KEY"]
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['PASSWORD_HASH_ROUNDS'] = int(os.environ.get(
+    "PASSWORD_HASH_ROUNDS", 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get(
+    "PASSWORD_HASH_WORKERS", 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get(
+    "PASSWORD_HASH_MAX_PENDING", 32))
+app.config['QUERY_STATS_HEADERS'] = (
+    os.environ.get("QUERY_STATS_HEADERS", "1") == "1")
+app.config['CURRENT_USER_CACHE_SIZE'] = int(os.environ.get(
+    "CURRENT_USER_CACHE_SIZE", 10_000))
+app.config['CURRENT_USER_CACHE_TTL'] = int(os.environ.get(
+    "CURRENT_USER_CACHE_TTL", 30))
+app.config['WRITE_BEHIND'] = os.environ.get("WRITE_BEHIND", "0") == "1"
+app.config['DELETION_IN_BACKGROUND'] = (
+    os.environ.get("DELETION_IN_BACKGROUND", "1") == "1")
+app.config['DELETION_BATCH_SIZE'] = int(os.environ.get(
+    "DELETION_BATCH_SIZE", 1000))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get(
+    "FRAGMENT_CACHE_SIZE", 20_000))
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.environ.get(
+    "STATIC_MAX_AGE", 86_400))
+app.config['ASSET_DIR'] = os.environ.get("ASSET_DIR", "dist")
+app.config['IMAGE_PROXY'] = os.environ.get("IMAGE_PROXY", "1") == "1"
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get(
+    "IMAGE_CACHE_MAX_BYTES", 1024 ** 3))
+if "IMAGE_CACHE_DIR" in os.environ:
+    app.config['IMAGE_CACHE_DIR'] = os.environ["IMAGE_CACHE_DIR"]
 
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+# schema changes go through migrations/ ("flask db upgrade"); batch mode
+# lets SQLite, which can't ALTER most things in place, run them too
+migrate = Migrate(
+    app, db, render_as_batch=True, include_name=include_in_migrations)
+replica_router.init_app(app)
+password_hasher.init_app(app)
+querystats.init_app(app)
+fragment_cache.init_app(app)
+assets.init_app(app)
+image_proxy.init_app(app)
+deletion_worker.init_app(app)
+app.register_blueprint(api)
+
+current_user_cache = LRUCache(
+    app.config['CURRENT_USER_CACHE_SIZE'],
+    ttl=app.config['CURRENT_USER_CACHE_TTL'])
+
+write_behind.init_app(
+    app, on_flush=lambda *user_ids: forget_current_user(*user_ids))
 
 
 ##############################################################################
@@ -32,14 +136,42 @@ connect_db(app)
 
 
 @app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+def reset_user_in_g():
+    """Forget the previous request's user; `g.user` loads it on demand."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.pop('user', None)
+
+
+def load_current_user():
+    """Return the logged-in user, or None if not logged in.
+
+    Rows are served from `current_user_cache` when possible, so most
+    requests don't hit the database just to identify the user.
+    """
+
+    if CURR_USER_KEY not in session:
+        return None
+
+    user_id = session[CURR_USER_KEY]
+    values = current_user_cache.get(user_id)
+
+    if values is not None:
+        return User.from_column_values(values)
+
+    user = db.session.get(User, user_id)
+
+    if user:
+        current_user_cache.set(user_id, user.column_values())
+
+    return user
+
+
+def forget_current_user(*user_ids):
+    """Drop users from `current_user_cache` after changing their rows."""
+
+    for user_id in user_ids:
+        current_user_cache.delete(user_id)
 
-    else:
-        g.user = None
 
 @app.before_request
 def add_csrf_to_g():
@@ -112,6 +244,8 @@ def login():
         )
 
         if user:
+            # saves the password hash if authenticate upgraded its cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -144,7 +278,9 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search for usernames starting
+    with it (top matches only), or else an 'after' cursor (last user id
+    seen) for the next page of the directory.
     """
 
     if not g.user:
@@ -153,49 +289,118 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if search:
+        page = Page(User.search(search), None)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        after = decode_user_cursor(request.args.get('after'))
+        page = paginate_users(
+        User.query.options(*User.card_loader()), User.id, after)
 
-    return render_template('users/index.html', users=users)
+    return render_conditional(
+        _validators(page.items),
+        lambda: render_template(
+            'users/index.html',
+            users=page.items,
+            following_ids=g.user.following_ids_among(
+                [u.id for u in page.items]),
+            next_cursor=page.next_cursor))
 
 
 @app.get('/users/<int:user_id>')
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile with a page of their messages, newest first.
+
+    Takes an optional 'before' cursor for older messages.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    before = decode_message_cursor(request.args.get('before'))
 
-    return render_template('users/show.html', user=user)
+    def render():
+        page = paginate_messages(
+            Message.query
+            .filter(Message.user_id == user.id)
+            .options(*Message.bare_loader()),
+            Message.timestamp,
+            Message.id,
+            before)
+
+        return render_template(
+            'users/show.html',
+            user=user,
+            messages=page.items,
+            liked_ids=g.user.liked_ids_among([m.id for m in page.items]),
+            next_cursor=page.next_cursor)
+
+    # posting or deleting a message bumps the author's row, so the profile
+    # row alone versions the whole page
+    return render_conditional(_validators([user]), render)
 
 
 @app.get('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time
+    (optional 'after' cursor)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    after = decode_user_cursor(request.args.get('after'))
+
+    page = paginate_users(
+        User.query
+        .join(Follow, Follow.user_being_followed_id == User.id)
+        .filter(Follow.user_following_id == user.id)
+        .options(*User.card_loader()),
+        User.id,
+        after)
+
+    return render_conditional(
+        _validators([user, *page.items]),
+        lambda: render_template(
+            'users/following.html',
+            user=user,
+            followed_users=page.items,
+            following_ids=g.user.following_ids_among(
+                [u.id for u in page.items]),
+            next_cursor=page.next_cursor))
 
 
 @app.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time (optional
+    'after' cursor)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    after = decode_user_cursor(request.args.get('after'))
+
+    page = paginate_users(
+        User.query
+        .join(Follow, Follow.user_following_id == User.id)
+        .filter(Follow.user_being_followed_id == user.id)
+        .options(*User.card_loader()),
+        User.id,
+        after)
+
+    return render_conditional(
+        _validators([user, *page.items]),
+        lambda: render_template(
+            'users/followers.html',
+            user=user,
+            followers=page.items,
+            following_ids=g.user.following_ids_among(
+                [u.id for u in page.items]),
+            next_cursor=page.next_cursor))
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -211,7 +416,14 @@ def start_following(follow_id):
 
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+
+    if write_behind.enabled:
+        write_behind.follow(g.user.id, followed_user.id)
+        return redirect(f"/users/{g.user.id}/following")
+
+    if Follow.add(g.user.id, followed_user.id):
+        forget_current_user(g.user.id, followed_user.id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -230,7 +442,14 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+
+    if write_behind.enabled:
+        write_behind.follow(g.user.id, followed_user.id, following=False)
+        return redirect(f"/users/{g.user.id}/following")
+
+    if Follow.remove(g.user.id, followed_user.id):
+        forget_current_user(g.user.id, followed_user.id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -256,12 +475,12 @@ def profile():
         user.bio = form.bio.data
         pwd = form.password.data
 
-        valid_user = User.authenticate(g.user.username, pwd)
-
-        if valid_user:
+        if user.check_password(pwd):
+            forget_current_user(user.id)
             db.session.commit()
             return redirect(f'/users/{user.id}')
         else:
+            db.session.rollback()
             form.username.errors = ["Invalid username/password."]
             return render_template("users/edit.html", form=form, user=g.user)
 
@@ -273,7 +492,8 @@ def profile():
 def delete_user():
     """Delete user.
 
-    Redirect to signup page.
+    The account disappears at once; its rows are purged in the background
+    (see DeletionJob). Redirect to signup page.
     """
 
     if not g.user or not g.csrf_form.validate_on_submit():
@@ -282,20 +502,46 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    forget_current_user(g.user.id)
+    DeletionJob.start(g.user)
     db.session.commit()
+    deletion_worker.wake()
 
     return redirect("/signup")
 
 @app.get('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
-    """display page of user's liked messages"""
+    """display page of user's liked messages, newest first (optional
+    'before' cursor)"""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    return render_template("messages/liked-messages.html")
+    user = User.query.get_or_404(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    page = paginate_messages(
+        Message.query
+        .join(Like, Like.message_id == Message.id)
+        .filter(Like.user_id == user.id)
+        .options(*Message.list_loader()),
+        Message.timestamp,
+        Message.id,
+        before)
+
+    messages = page.items
+
+    return render_conditional(
+        _validators([user, *(m.user for m in messages)], messages),
+        lambda: render_template(
+            "messages/liked-messages.html",
+            user=user,
+            messages=messages,
+            liked_ids=g.user.liked_ids_among([m.id for m in messages]),
+            following_ids=g.user.following_ids_among(
+                {m.user_id for m in messages}),
+            next_cursor=page.next_cursor))
 
 
 ##############################################################################
@@ -315,8 +561,13 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.push(msg)
+        MessageSearch.add(msg)
+        User.adjust_counts(g.user.id, messages_count=1)
+        forget_current_user(g.user.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -324,6 +575,50 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+def search_messages():
+    """Search messages' text, best matches first.
+
+    Takes the words to look for as 'q', and optionally an 'author'
+    username, 'since' and 'until' dates (YYYY-MM-DD) and an 'after' cursor
+    for the next page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    filters = dict(
+        q=request.args.get('q', ''),
+        author=request.args.get('author', ''),
+        since=request.args.get('since', ''),
+        until=request.args.get('until', ''),
+    )
+
+    page = MessageSearch.search(
+        filters['q'],
+        author=filters['author'],
+        since=decode_date(filters['since']),
+        until=decode_date(filters['until']),
+        after=decode_search_cursor(request.args.get('after')))
+
+    messages = in_order(
+        Message.query
+        .options(*Message.list_loader())
+        .filter(Message.id.in_(page.items))
+        .all(),
+        page.items)
+
+    return render_conditional(
+        _validators([m.user for m in messages], messages),
+        lambda: render_template(
+            'messages/search.html',
+            filters=filters,
+            messages=messages,
+            liked_ids=g.user.liked_ids_among([m.id for m in messages]),
+            next_cursor=page.next_cursor))
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -332,8 +627,17 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message.query
+           .options(*Message.list_loader())
+           .filter(Message.id == message_id)
+           .first_or_404())
+
+    return render_conditional(
+        _validators([msg.user], [msg]),
+        lambda: render_template(
+            'messages/show.html',
+            message=msg,
+            liked_ids=g.user.liked_ids_among([msg.id])))
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -349,6 +653,12 @@ def delete_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
+    TimelineEntry.remove(msg.id)
+    User.adjust_counts(msg.user_id, messages_count=-1)
+    User.adjust_counts(
+        db.select(Like.user_id).where(Like.message_id == msg.id),
+        likes_count=-1)
+    forget_current_user(msg.user_id)
     db.session.delete(msg)
     db.session.commit()
 
@@ -363,7 +673,14 @@ def like_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
-    g.user.likes.append(msg)
+
+    if write_behind.enabled:
+        write_behind.like(g.user.id, msg.id)
+        return redirect(f"/users/{g.user.id}/likes")
+
+    if Like.add(g.user.id, msg.id):
+        forget_current_user(g.user.id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/likes")
@@ -377,11 +694,45 @@ def unlike_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
-    g.user.likes.remove(msg)
+
+    if write_behind.enabled:
+        write_behind.like(g.user.id, msg.id, liked=False)
+        return redirect(f"/users/{g.user.id}/likes")
+
+    if Like.remove(g.user.id, msg.id):
+        forget_current_user(g.user.id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/likes")
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('recount')
+def recount_command():
+    """Recompute every user's message/follow/like counters."""
+
+    User.recount()
+    db.session.commit()
+    print("Counters recomputed.")
+
+
+@app.cli.command('rebuild-suggestions')
+@click.option('--batch-size', default=REBUILD_BATCH_SIZE, show_default=True,
+              help="Users recomputed (and committed) at a time.")
+def rebuild_suggestions_command(batch_size):
+    """Recompute every user's follow suggestions from the follow graph.
+
+    Follows only adjust the follower's own suggestions; run this
+    periodically (e.g. nightly) to pick up everyone else's changes.
+    """
+
+    users = FollowSuggestion.rebuild(batch_size)
+    print(f"Suggestions recomputed for {users} users.")
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -391,28 +742,65 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: most recent messages of self & followed_users, a page at a
+      time (optional 'before' cursor), read from the user's precomputed
+      timeline
+    - logged in: a few "who to follow" suggestions, precomputed (see
+      FollowSuggestion)
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        before = decode_message_cursor(request.args.get('before'))
+
+        page = Message.feed_page(
+            Message.query.options(*Message.list_loader()),
+            g.user.id,
+            before)
+
+        messages = page.items
+        suggestions = FollowSuggestion.top(
+            User.query.options(*User.card_loader()),
+            g.user.id,
+            SUGGESTIONS_SHOWN)
+
+        return render_conditional(
+            _validators(
+                [m.user for m in messages] + [u for u, _ in suggestions],
+                messages,
+                [(u.id, mutuals) for u, mutuals in suggestions]),
+            lambda: render_template(
+                'home.html',
+                messages=messages,
+                suggestions=suggestions,
+                liked_ids=g.user.liked_ids_among([m.id for m in messages]),
+                next_cursor=page.next_cursor))
 
     else:
         return render_template('home-anon.html')
 
 
+def _validators(users, messages=(), extra=()):
+    """Validators for a page showing `users` and `messages`, as seen by
+    g.user (whose row versions their follow/like state); `extra` is
+    anything else on the page that changes without those rows."""
+
+    # messages never change, only appear and disappear, so ids cover them;
+    # the asset build is in there so a deploy's new asset URLs reach pages
+    # browsers already hold
+    return Validators(
+        (assets.version, g.user.id, g.user.updated_at,
+         [(u.id, u.updated_at) for u in users],
+         [m.id for m in messages], extra),
+        updated=[g.user.updated_at, *(u.updated_at for u in users)])
+
+
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses without a caching policy of
+    their own (static files and conditional pages set one)."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not response.cache_control:
+        response.cache_control.no_store = True
+
     return response
@@ -0,0 +1,116 @@
+"""Fingerprinted, precompressed static assets for Warbler.
+
+`python build_assets.py` copies every file under static/ to
+static/<ASSET_DIR>/ with a hash of its contents in the name
+(stylesheets/style.css -> dist/stylesheets/style.3b1f0c9e2d4a.css), writes
+gzip and brotli variants next to the compressible ones, and records it all
+in a manifest. Templates link assets with
+
+    {{ asset_url('static', filename='stylesheets/style.css') }}
+
+which takes the same arguments as url_for and gives the hashed URL when
+the file is in the manifest (the plain one otherwise, e.g. before a build).
+A hashed file's URL changes whenever its contents do, so it's served as
+cacheable for a year and immutable; and it's served from its .br or .gz
+variant to browsers that accept one.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for
+
+DEFAULT_ASSET_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class AssetManifest:
+    """The asset build's manifest, and the static view that serves it.
+
+    Configured from the app's ASSET_DIR (where build_assets.py put its
+    output, relative to the static folder).
+    """
+
+    def __init__(self):
+        self.app = None
+        self.files = {}
+        self.encodings = {}
+        self.version = None
+
+    def init_app(self, app):
+        """Load the manifest, add `asset_url` to templates and serve static
+        files through `send_static_file`."""
+
+        self.app = app
+        app.config.setdefault('ASSET_DIR', DEFAULT_ASSET_DIR)
+        self.load()
+
+        app.jinja_env.globals['asset_url'] = self.url_for
+        app.view_functions['static'] = self.send_static_file
+
+    def load(self):
+        """(Re)read the manifest; without one, assets use their plain URLs."""
+
+        path = os.path.join(
+            self.app.static_folder, self.app.config['ASSET_DIR'],
+            MANIFEST_NAME)
+
+        try:
+            with open(path, 'rb') as manifest_file:
+                raw = manifest_file.read()
+        except FileNotFoundError:
+            raw = b'{}'
+
+        manifest = json.loads(raw)
+        # {source filename: hashed filename}
+        self.files = manifest.get('files', {})
+        # {hashed filename: encodings it has variants for}
+        self.encodings = manifest.get('encodings', {})
+        # changes with any asset, for pages that link them
+        self.version = hashlib.sha1(raw).hexdigest()
+
+    def url_for(self, endpoint, **values):
+        """url_for, with static filenames swapped for their hashed ones."""
+
+        if endpoint == 'static' and values.get('filename') in self.files:
+            values['filename'] = self.files[values['filename']]
+
+        return url_for(endpoint, **values)
+
+    def send_static_file(self, filename):
+        """Serve static file `filename`, from a precompressed variant if it
+        has one the browser accepts; hashed files are cached for good."""
+
+        response = None
+
+        for encoding, suffix in ENCODINGS:
+            if (encoding in self.encodings.get(filename, ())
+                    and request.accept_encodings[encoding]):
+                response = send_from_directory(
+                    self.app.static_folder,
+                    filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0],
+                    max_age=IMMUTABLE_MAX_AGE)
+                response.content_encoding = encoding
+                break
+
+        if response is None:
+            response = self.app.send_static_file(filename)
+
+        if filename in self.encodings:
+            response.vary.add('Accept-Encoding')
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+
+        return response
+
+
+assets = AssetManifest()
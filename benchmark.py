@@ -0,0 +1,352 @@
+"""Route-level load test and latency benchmark for Warbler.
+
+Drives every main route with concurrent clients, logged in as random users,
+and reports throughput and p50/p95/p99 latency per route. Results are saved
+as JSON so runs can be compared:
+
+    # load a dataset of a given size (this wipes the database!) and run
+    python benchmark.py --database-url postgresql:///warbler_bench \\
+        --seed --users 100000 --messages 1000000 --follows 5000000
+
+    # run again against the same data and compare with the first run
+    python benchmark.py --database-url postgresql:///warbler_bench \\
+        --output after.json --compare bench_results.json
+
+By default requests go through Flask's test client in this process; pass
+--base-url to drive a running server instead (its database must hold the
+same data, since users and messages are picked from --database-url).
+Seeded users all have the password "password".
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+DEFAULT_REQUESTS = 200
+DEFAULT_CONCURRENCY = 8
+DEFAULT_OUTPUT = 'bench_results.json'
+DEFAULT_THRESHOLD = 0.10
+SAMPLE_SIZE = 1000
+
+# route name -> function of (sample, random.Random) giving (method, path).
+# Write routes come in do/undo pairs so repeated runs leave data unchanged.
+ROUTES = {
+    'homepage': lambda s, r: ('GET', '/'),
+    'list_users': lambda s, r: ('GET', '/users'),
+    'search_users': lambda s, r: ('GET', f'/users?q={r.choice(s.usernames)[:3]}'),
+    'show_user': lambda s, r: ('GET', f'/users/{r.choice(s.user_ids)}'),
+    'show_following': lambda s, r: (
+        'GET', f'/users/{r.choice(s.user_ids)}/following'),
+    'show_followers': lambda s, r: (
+        'GET', f'/users/{r.choice(s.user_ids)}/followers'),
+    'show_liked_messages': lambda s, r: (
+        'GET', f'/users/{r.choice(s.user_ids)}/likes'),
+    'show_message': lambda s, r: (
+        'GET', f'/messages/{r.choice(s.message_ids)}'),
+}
+
+WRITE_ROUTES = {
+    'like_message': ('/messages/{}/like', '/messages/{}/unlike', 'message_ids'),
+    'start_following': (
+        '/users/follow/{}', '/users/stop-following/{}', 'user_ids'),
+}
+
+
+class Sample:
+    """Ids and usernames picked at random from the database to request."""
+
+    def __init__(self, db, User, Message):
+        def pick(column):
+            return list(db.session.scalars(
+                db.select(column).order_by(db.func.random()).limit(SAMPLE_SIZE)))
+
+        self.user_ids = pick(User.id)
+        self.usernames = pick(User.username)
+        self.message_ids = pick(Message.id)
+
+        if not self.user_ids or not self.message_ids:
+            sys.exit("No users or messages to benchmark; run with --seed.")
+
+
+class InProcessClient:
+    """Sends requests through Flask's test client, logged in as `user_id`."""
+
+    def __init__(self, app, user_id):
+        from app import CURR_USER_KEY
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def request(self, method, path):
+        return self.client.open(path, method=method).status_code
+
+
+class HTTPClient:
+    """Sends requests to a running server, logged in as `username`."""
+
+    def __init__(self, base_url, username):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect)
+        self.request('POST', '/login', dict(
+            username=username, password='password'))
+
+    def request(self, method, path, form=None):
+        data = urllib.parse.urlencode(form or {}).encode()
+        req = urllib.request.Request(
+            self.base_url + path,
+            data=data if method == 'POST' else None,
+            method=method)
+
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses instead of following them."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    index = max(0, round(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    """Stats for one route from its latencies (seconds)."""
+
+    latencies.sort()
+
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        throughput_rps=round(len(latencies) / elapsed, 1),
+        mean_ms=round(statistics.fmean(latencies) * 1000, 2),
+        p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        p95_ms=round(percentile(latencies, 95) * 1000, 2),
+        p99_ms=round(percentile(latencies, 99) * 1000, 2),
+    )
+
+
+def run_route(make_client, sample, requests_per_route, concurrency, plan):
+    """Send `requests_per_route` requests from `concurrency` threads.
+
+    `plan(sample, rng)` returns a list of (method, path) to send in order;
+    each one counts as a request. Returns the route's stats.
+    """
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    per_thread = max(1, requests_per_route // concurrency)
+
+    def worker(seed):
+        nonlocal errors
+        rng = random.Random(seed)
+        client = make_client(rng)
+        timings = []
+        failed = 0
+
+        while len(timings) < per_thread:
+            for method, path in plan(sample, rng):
+                started = time.perf_counter()
+                status = client.request(method, path)
+                timings.append(time.perf_counter() - started)
+
+                if status >= 400:
+                    failed += 1
+
+        with lock:
+            latencies.extend(timings)
+            errors += failed
+
+    threads = [
+        threading.Thread(target=worker, args=(seed,))
+        for seed in range(concurrency)
+    ]
+    started = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def route_plans():
+    """Every route's plan: read routes send one request, write routes a
+    do/undo pair on the same target."""
+
+    plans = {
+        name: (lambda route: lambda s, r: [route(s, r)])(route)
+        for name, route in ROUTES.items()
+    }
+
+    for name, (do, undo, ids) in WRITE_ROUTES.items():
+        def plan(s, r, do=do, undo=undo, ids=ids):
+            target = r.choice(getattr(s, ids))
+            return [('POST', do.format(target)), ('POST', undo.format(target))]
+
+        plans[name] = plan
+
+    return plans
+
+
+def seed_database(options):
+    """Generate a dataset of the requested size and load it."""
+
+    import seed
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([
+            sys.executable, 'generator/create_csvs.py',
+            '--out', data_dir,
+            '--users', str(options.users),
+            '--messages', str(options.messages),
+            '--follows', str(options.follows),
+            '--likes', str(options.likes),
+        ], check=True)
+        seed.seed(data_dir)
+
+
+def compare(results, baseline, threshold):
+    """Print per-route changes against `baseline`; return regressed names.
+
+    A route regresses if its p95 latency grew, or its throughput fell, by
+    more than `threshold` (a fraction).
+    """
+
+    regressed = []
+
+    print(f"\n{'route':<22}{'p95 before':>12}{'p95 after':>12}"
+          f"{'rps before':>12}{'rps after':>12}")
+
+    for name, now in results['routes'].items():
+        before = baseline['routes'].get(name)
+
+        if not before:
+            continue
+
+        slower = now['p95_ms'] > before['p95_ms'] * (1 + threshold)
+        fewer = now['throughput_rps'] < before['throughput_rps'] * (1 - threshold)
+        flag = "  REGRESSED" if slower or fewer else ""
+
+        if flag:
+            regressed.append(name)
+
+        print(f"{name:<22}{before['p95_ms']:>12}{now['p95_ms']:>12}"
+              f"{before['throughput_rps']:>12}{now['throughput_rps']:>12}{flag}")
+
+    return regressed
+
+
+def main(options):
+    if options.database_url:
+        os.environ['DATABASE_URL'] = options.database_url
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+    from app import app
+    from models import db, User, Message
+
+    if options.seed:
+        seed_database(options)
+
+    sample = Sample(db, User, Message)
+    user_by_id = dict(zip(sample.user_ids, sample.usernames))
+
+    if options.base_url:
+        usernames = list(db.session.scalars(
+            db.select(User.username).where(User.id.in_(sample.user_ids))))
+
+        def make_client(rng):
+            return HTTPClient(options.base_url, rng.choice(usernames))
+    else:
+        def make_client(rng):
+            return InProcessClient(app, rng.choice(list(user_by_id)))
+
+    plans = route_plans()
+    names = options.routes or list(plans)
+    results = dict(
+        meta=dict(
+            started=datetime.now().isoformat(timespec='seconds'),
+            requests_per_route=options.requests,
+            concurrency=options.concurrency,
+            target=options.base_url or 'in-process',
+            users=db.session.query(User).count(),
+            messages=db.session.query(Message).count(),
+        ),
+        routes={},
+    )
+
+    print(f"{'route':<22}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'errors':>8}")
+
+    for name in names:
+        stats = run_route(
+            make_client, sample, options.requests, options.concurrency,
+            plans[name])
+        results['routes'][name] = stats
+
+        print(f"{name:<22}{stats['throughput_rps']:>9}{stats['p50_ms']:>9}"
+              f"{stats['p95_ms']:>9}{stats['p99_ms']:>9}{stats['errors']:>8}")
+
+    with open(options.output, 'w') as out:
+        json.dump(results, out, indent=2)
+
+    print(f"\nSaved results to {options.output}")
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            regressed = compare(
+                results, json.load(baseline_file), options.threshold)
+
+        if regressed:
+            sys.exit(f"\nRegressed: {', '.join(regressed)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--database-url',
+                        help="database to benchmark (default: DATABASE_URL)")
+    parser.add_argument('--base-url',
+                        help="drive a running server instead of in-process")
+    parser.add_argument('--seed', action='store_true',
+                        help="wipe the database and load a generated dataset")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--follows', type=int, default=20_000)
+    parser.add_argument('--likes', type=int, default=20_000)
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help="requests per route")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--routes', nargs='*', choices=[
+        *ROUTES, *WRITE_ROUTES])
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help="earlier results JSON to compare")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="fraction of change that counts as a regression")
+
+    main(parser.parse_args())
@@ -0,0 +1,169 @@
+"""Build fingerprinted, precompressed copies of Warbler's static files.
+
+For each file under static/ this writes, under static/dist/:
+
+    stylesheets/style.3b1f0c9e2d4a.css      contents hash in the name
+    stylesheets/style.3b1f0c9e2d4a.css.gz   gzip variant
+    stylesheets/style.3b1f0c9e2d4a.css.br   brotli variant (needs Brotli)
+
+plus manifest.json, which assets.py reads at startup to link and serve
+them. Variants are only written for compressible types (not images that
+are already compressed) and only when they come out smaller. Stylesheet
+url(/static/...) references are rewritten to the hashed names, so a
+changed image gives the stylesheet a new hash too.
+
+Run it as part of each deploy, before starting the app:
+
+    python build_assets.py
+    python build_assets.py --clean     # drop earlier builds' files first
+
+Files from earlier builds are kept by default: pages (or servers) still on
+the previous version may ask for them during a rolling deploy.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from assets import DEFAULT_ASSET_DIR, MANIFEST_NAME
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_STATIC_FOLDER = 'static'
+
+HASH_LENGTH = 12
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+    'image/vnd.microsoft.icon',
+    'image/x-icon',
+}
+
+# url("/static/images/nav-bg.png") and the like, in stylesheets
+CSS_STATIC_URL = re.compile(r'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+
+def is_compressible(filename):
+    mimetype = mimetypes.guess_type(filename)[0] or ''
+
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def hashed_name(filename, data):
+    """`filename` with the hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(filename)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+    return f"{root}.{digest}{ext}"
+
+
+def compressed_variants(data):
+    """{encoding: (suffix, bytes)} for the variants smaller than `data`."""
+
+    variants = {'gzip': ('.gz', gzip.compress(data, 9, mtime=0))}
+
+    if brotli is not None:
+        variants['br'] = ('.br', brotli.compress(data, quality=11))
+
+    return {
+        encoding: variant
+        for encoding, variant in variants.items()
+        if len(variant[1]) < len(data)
+    }
+
+
+def source_files(static_folder, asset_dir):
+    """Static files to build (paths relative to `static_folder`), other
+    assets before stylesheets so those can point at their hashed names."""
+
+    found = []
+
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and asset_dir in dirs:
+            dirs.remove(asset_dir)
+
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_folder)
+            found.append(path.replace(os.sep, '/'))
+
+    return sorted(found, key=lambda path: (path.endswith('.css'), path))
+
+
+def build(static_folder=DEFAULT_STATIC_FOLDER, asset_dir=DEFAULT_ASSET_DIR,
+          clean=False):
+    """Build every static file into `static_folder`/`asset_dir` (emptied
+    first if `clean`); return the manifest."""
+
+    output_folder = os.path.join(static_folder, asset_dir)
+
+    if clean:
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+    files = {}
+    encodings = {}
+
+    def rewrite_url(match):
+        quote, filename = match.groups()
+        return f"url({quote}/static/{files.get(filename, filename)}{quote})"
+
+    for filename in source_files(static_folder, asset_dir):
+        with open(os.path.join(static_folder, filename), 'rb') as source:
+            data = source.read()
+
+        if filename.endswith('.css'):
+            data = CSS_STATIC_URL.sub(
+                rewrite_url, data.decode('utf-8')).encode('utf-8')
+
+        built = f"{asset_dir}/{hashed_name(filename, data)}"
+        path = os.path.join(static_folder, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as output:
+            output.write(data)
+
+        variants = (
+            compressed_variants(data) if is_compressible(filename) else {})
+
+        for suffix, compressed in variants.values():
+            with open(path + suffix, 'wb') as output:
+                output.write(compressed)
+
+        files[filename] = built
+        encodings[built] = sorted(variants)
+
+    manifest = dict(files=files, encodings=encodings)
+
+    # written last, and swapped in whole, so a running app never reads a
+    # manifest pointing at files not written yet
+    path = os.path.join(output_folder, MANIFEST_NAME)
+
+    with open(path + '.tmp', 'w') as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+
+    os.replace(path + '.tmp', path)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--static-folder', default=DEFAULT_STATIC_FOLDER)
+    parser.add_argument('--asset-dir', default=DEFAULT_ASSET_DIR)
+    parser.add_argument('--clean', action='store_true')
+    args = parser.parse_args()
+
+    manifest = build(args.static_folder, args.asset_dir, args.clean)
+
+    print(f"Built {len(manifest['files'])} assets"
+          f"{'' if brotli else ' (no brotli: pip install Brotli)'}.")
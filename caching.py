@@ -0,0 +1,68 @@
+"""In-process caches for Warbler."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """Thread-safe mapping capped at `maxsize` entries, least recently used
+    evicted first. If `ttl` (seconds) is given, entries older than that are
+    treated as missing.
+
+    A `maxsize` of 0 disables the cache: nothing is stored.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            value, expires = entry
+
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        if self.maxsize <= 0:
+            return
+
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
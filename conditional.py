@@ -0,0 +1,87 @@
+"""Conditional GET (ETag / Last-Modified) for Warbler's pages.
+
+A view describes what a page shows before rendering it: the ids and
+`updated_at` stamps of the rows on it, including the viewer's own row
+(their follow/like state is on every page). If the browser already has
+that version, the view answers 304 Not Modified without rendering:
+
+    validators = Validators(
+        (g.user.id, g.user.updated_at, user.id, user.updated_at),
+        updated=(g.user.updated_at, user.updated_at))
+
+    return render_conditional(
+        validators, lambda: render_template('users/show.html', ...))
+
+Anything only the template needs (e.g. the viewer's liked ids) belongs in
+the render callable, so a 304 skips those queries too.
+
+Pages are personalized, so they're only cached by the browser (private)
+and always revalidated (no-cache).
+"""
+
+import hashlib
+from datetime import timezone
+
+from flask import current_app, make_response, request, session
+
+
+class Validators:
+    """ETag and Last-Modified for one version of a page.
+
+    `parts` is anything with a stable repr that changes whenever the page
+    would; `updated` are the datetimes (UTC) of the rows it shows.
+    """
+
+    def __init__(self, parts, updated=()):
+        # the URL is part of the version: query args pick the page shown
+        self.etag = hashlib.sha1(
+            repr((request.full_path, parts)).encode()).hexdigest()
+
+        stamps = [stamp for stamp in updated if stamp is not None]
+        self.last_modified = (
+            max(stamps).replace(microsecond=0, tzinfo=timezone.utc)
+            if stamps else None)
+
+    def not_modified(self):
+        """Does the request already hold this version of the page?"""
+
+        # a pending flash message must be rendered, so never skip that
+        if session.get('_flashes'):
+            return False
+
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+
+        if self.last_modified and request.if_modified_since:
+            return request.if_modified_since >= self.last_modified
+
+        return False
+
+    def not_modified_response(self):
+        """Empty 304 response carrying the validators."""
+
+        return self.apply(current_app.response_class(status=304))
+
+    def apply(self, response):
+        """Set validators and the page caching policy on `response`."""
+
+        response.set_etag(self.etag)
+
+        if self.last_modified:
+            response.last_modified = self.last_modified
+
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+
+        return response
+
+
+def render_conditional(validators, render):
+    """304 if the client has `validators`' version of the page, else the
+    response of calling `render()` with the validators set on it."""
+
+    if validators.not_modified():
+        return validators.not_modified_response()
+
+    return validators.apply(make_response(render()))
@@ -0,0 +1,98 @@
+"""Background runner for account deletions (see models.DeletionJob).
+
+`delete_user` hides the account and records a job, then wakes the worker
+thread, which purges the account's rows DELETION_BATCH_SIZE at a time,
+pausing DELETION_BATCH_PAUSE_MS between batches so other writers get the
+tables in between. With DELETION_IN_BACKGROUND off (e.g. in tests) jobs
+only run when asked:
+
+    flask purge-deleted-users
+
+which also finishes any job a crash or restart interrupted.
+"""
+
+import logging
+import threading
+
+from models import db, DeletionJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_PAUSE_MS = 10
+
+# how often the worker looks for jobs it wasn't woken for (seconds)
+POLL_INTERVAL = 60
+
+
+class DeletionWorker:
+    """Thread that runs pending DeletionJobs.
+
+    Configured from the app's DELETION_IN_BACKGROUND, DELETION_BATCH_SIZE
+    and DELETION_BATCH_PAUSE_MS.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read settings from `app.config` and add the CLI command."""
+
+        self.app = app
+        app.config.setdefault('DELETION_IN_BACKGROUND', True)
+        app.config.setdefault('DELETION_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        app.config.setdefault('DELETION_BATCH_PAUSE_MS', DEFAULT_BATCH_PAUSE_MS)
+
+        @app.cli.command('purge-deleted-users')
+        def purge_command():
+            """Run every unfinished account deletion to completion."""
+
+            print(f"Purged {self.run_pending()} deleted account(s).")
+
+    def wake(self):
+        """Have the worker pick up new jobs now (starting it if needed)."""
+
+        if not self.app.config['DELETION_IN_BACKGROUND']:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='deletion', daemon=True)
+                self._thread.start()
+
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception("Account deletion failed; will retry")
+
+    def run_pending(self):
+        """Run pending jobs to completion; return how many finished."""
+
+        config = self.app.config
+
+        with self.app.app_context():
+            jobs = DeletionJob.pending()
+
+            for job in jobs:
+                logger.info("Purging deleted user %d from stage %s",
+                            job.user_id, job.stage)
+                job.run(config['DELETION_BATCH_SIZE'],
+                        config['DELETION_BATCH_PAUSE_MS'] / 1000)
+
+            db.session.commit()
+
+        return len(jobs)
+
+
+deletion_worker = DeletionWorker()
@@ -0,0 +1,88 @@
+"""Cached rendering of list items that look the same to every viewer.
+
+Message items and user cards are rendered once per (entity, version) and
+kept in an LRU cache. Only the viewer-specific part, the like or follow
+button, is rendered per request and spliced in where the fragment has its
+`actions` placeholder. In a template:
+
+    {% call cached_message(msg, msg.user) %}
+      ... like/unlike button for g.user ...
+    {% endcall %}
+
+Fragment templates must only use what they're passed (not g, session or
+request), since their output is shared between viewers.
+"""
+
+from flask import current_app
+from markupsafe import Markup
+
+from caching import LRUCache
+
+ACTIONS_PLACEHOLDER = Markup("<!--actions-->")
+
+
+class FragmentCache:
+    """Rendered fragments split around their actions placeholder, keyed by
+    template, entity id and version."""
+
+    def __init__(self):
+        self._cache = LRUCache(0)
+
+    def init_app(self, app):
+        """Size the cache from FRAGMENT_CACHE_SIZE (0 disables it) and make
+        the fragment helpers available to templates."""
+
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 20_000)
+        self._cache.maxsize = app.config['FRAGMENT_CACHE_SIZE']
+
+        app.jinja_env.globals.update(
+            cached_message=self.message,
+            cached_user_card=self.user_card,
+        )
+
+    def render(self, template_name, key, caller, **context):
+        """Render `template_name` with `context`, or reuse its cached
+        rendering for `key`, with `caller()` in place of its actions."""
+
+        key = (template_name, *key)
+        parts = self._cache.get(key)
+
+        if parts is None:
+            html = current_app.jinja_env.get_template(template_name).render(
+                actions=ACTIONS_PLACEHOLDER, **context)
+            parts = html.split(ACTIONS_PLACEHOLDER, 1)
+            self._cache.set(key, parts)
+
+        head, tail = parts
+        return Markup(head) + caller() + Markup(tail)
+
+    def message(self, message, author, caller):
+        """A message's list item. Messages never change, so the author's
+        row is what versions it."""
+
+        return self.render(
+            'messages/_item.html',
+            (message.id, author.id, author.updated_at),
+            caller,
+            message=message,
+            author=author)
+
+    def user_card(self, user, caller):
+        """A user's card, as in the user directory."""
+
+        return self.render(
+            'users/_card.html',
+            (user.id, user.updated_at),
+            caller,
+            user=user)
+
+    def clear(self):
+        """Forget every rendered fragment."""
+
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+fragment_cache = FragmentCache()
@@ -2,36 +2,57 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 50000000 \\
+        --follows 200000000 --workers 16
+
+Output is deterministic for a given --seed, whatever the number of workers:
+rows are generated in fixed-size chunks, each with its own seeded random
+generator, spread over worker processes and concatenated in order. Rows are
+streamed to disk, and follow/like edges are drawn one follower at a time
+from a power-law popularity distribution (a few accounts get most of the
+follows), so memory use doesn't grow with the data size. Everything runs
+offline; image URLs come from local pools.
 """
 
+import argparse
+import csv
 import os
-from dotenv import load_dotenv
+import random
+import shutil
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
 from faker import Faker
-from helpers import get_random_datetime
-
-load_dotenv()
-
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
+from faker.providers.lorem.en_US import Provider as LoremProvider
+from helpers import get_random_datetime, PowerLawSampler
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
 
-fake = Faker()
+# Rows per chunk of work; part of the seed, so changing it changes output
+CHUNK_ROWS = 50_000
 
-# Generate random profile image URLs to use for users
+# Fixed so output is reproducible; messages fall in the two years before it
+DEFAULT_UNTIL = datetime(2023, 6, 1)
+
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+GENERATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -39,51 +60,181 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
+# Header image URLs to use for users, collected once from the Unsplash
+# wallpapers topic so generating data never needs the API
 
-header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
-]
+with open(os.path.join(GENERATOR_DIR, 'header_image_urls.txt')) as urls:
+    header_image_urls = urls.read().split()
+
+words = LoremProvider.word_list
+
+
+def chunk_rng(options, table, chunk):
+    """Random generator for one chunk of one table."""
+
+    return random.Random(f"{options.seed}-{table}-{chunk}")
+
+
+def write_users(options, chunk, start, stop, out):
+    """Write users with ids start..stop-1 to csv writer `out`."""
+
+    rng = chunk_rng(options, 'users', chunk)
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+
+    for user_id in range(start, stop):
+        # the id suffix keeps usernames (and so emails) unique
+        username = f"{fake.user_name()[:20]}_{user_id}"
+
+        out.writerow([
+            f"{username}@example.com",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city()[:30],
+        ])
+
+
+def write_messages(options, chunk, start, stop, out):
+    """Write messages start..stop-1 to csv writer `out`.
+
+    How often a user posts follows the same power law as popularity.
+    """
+
+    rng = chunk_rng(options, 'messages', chunk)
+    authors = PowerLawSampler(options.users, options.exponent)
+
+    for _ in range(start, stop):
+        text = " ".join(rng.choices(words, k=rng.randint(3, 24))).capitalize()
+
+        out.writerow([
+            text[:MAX_WARBLER_LENGTH - 1] + ".",
+            get_random_datetime(now=options.until, rng=rng),
+            authors.sample(rng),
+        ])
+
+
+def write_edges(rng, sources, targets, mean_degree, exclude_self, out,
+                reverse=False):
+    """Write (source, target) edges for each id in `sources`.
+
+    Each source gets an exponentially distributed number of distinct
+    targets drawn from PowerLawSampler `targets`.
+    """
+
+    max_degree = targets.n - 1 if exclude_self else targets.n
+
+    for source in sources:
+        degree = min(round(rng.expovariate(1 / mean_degree)), max_degree)
+        picked = set()
+
+        while len(picked) < degree:
+            target = targets.sample(rng)
+
+            if not (exclude_self and target == source):
+                picked.add(target)
+
+        for target in picked:
+            out.writerow((target, source) if reverse else (source, target))
+
+
+def write_follows(options, chunk, start, stop, out):
+    """Write follows by users start..stop-1 to csv writer `out`."""
+
+    write_edges(
+        chunk_rng(options, 'follows', chunk),
+        range(start, stop),
+        PowerLawSampler(options.users, options.exponent),
+        options.follows / options.users,
+        exclude_self=True,
+        out=out,
+        reverse=True)
+
+
+def write_likes(options, chunk, start, stop, out):
+    """Write likes by users start..stop-1 to csv writer `out`."""
+
+    write_edges(
+        chunk_rng(options, 'likes', chunk),
+        range(start, stop),
+        PowerLawSampler(options.messages, options.exponent),
+        options.likes / options.users,
+        exclude_self=False,
+        out=out)
+
+
+def write_part(task):
+    """Generate one chunk into its own part file; return the file's path."""
+
+    writer, options, chunk, start, stop, path = task
+
+    with open(path, 'w', newline='') as part:
+        writer(options, chunk, start, stop, csv.writer(part))
+
+    return path
+
+
+def generate(options, filename, headers, writer, total, workers):
+    """Generate `total` rows (or, for edges, rows for `total` sources) into
+    `filename`, CHUNK_ROWS at a time across `workers` processes."""
+
+    path = os.path.join(options.out, filename)
+    parts_dir = tempfile.mkdtemp(dir=options.out)
+
+    tasks = [
+        (writer, options, chunk, start, min(start + CHUNK_ROWS, total + 1),
+         os.path.join(parts_dir, f"{chunk}.csv"))
+        for chunk, start in enumerate(range(1, total + 1, CHUNK_ROWS))
+    ]
+
+    try:
+        with Pool(workers) as pool, open(path, 'w', newline='') as out:
+            csv.writer(out).writerow(headers)
+
+            for part_path in pool.imap(write_part, tasks):
+                with open(part_path, newline='') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(part_path)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    print(f"Wrote {path}")
+
+
+def main(options):
+    workers = options.workers
+
+    generate(options, 'users.csv', USERS_CSV_HEADERS,
+             write_users, options.users, workers)
+    generate(options, 'messages.csv', MESSAGES_CSV_HEADERS,
+             write_messages, options.messages, workers)
+
+    # Generate follows.csv from power-law pairings of users
+
+    generate(options, 'follows.csv', FOLLOWS_CSV_HEADERS,
+             write_follows, options.users, workers)
+
+    if options.likes:
+        generate(options, 'likes.csv', LIKES_CSV_HEADERS,
+                 write_likes, options.users, workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="approximate number of follows")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="approximate number of likes (0: no likes.csv)")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--exponent', type=float, default=1.2,
+                        help="power-law exponent for popularity (not 1)")
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=DEFAULT_UNTIL)
+    parser.add_argument('--out', default=GENERATOR_DIR)
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    main(parser.parse_args())
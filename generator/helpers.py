@@ -1,14 +1,56 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, now=None, rng=random):
+    """Get a random datetime within the `year_gap` years before `now`.
 
-    now = datetime.now()
+    Pass a seeded `rng` (and a fixed `now`) for reproducible output.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class PowerLawSampler:
+    """Draw ids in 1..n where id popularity follows a power law.
+
+    The rank-r most popular id is drawn with probability proportional to
+    r ** -exponent, by inverting the CDF of a continuous power law, so it
+    needs O(1) memory however large n is. Ranks are scattered over the id
+    range with a fixed multiplicative permutation, so popular ids aren't
+    simply the lowest ones. `exponent` must not be 1.
+    """
+
+    def __init__(self, n, exponent=1.2):
+        self.n = n
+        self.exponent = exponent
+        self._one_minus = 1 - exponent
+        self._span = (n + 1) ** self._one_minus - 1
+        self._step = self._coprime_step(n)
+
+    @staticmethod
+    def _coprime_step(n):
+        """A multiplier coprime with n (so rank -> id is a permutation)."""
+
+        step = int(n * 0.618) | 1
+
+        while gcd(step, n) != 1:
+            step += 2
+
+        return step
+
+    def sample(self, rng):
+        """Return one id, using random.Random `rng`."""
+
+        rank = int((self._span * rng.random() + 1) ** (1 / self._one_minus))
+        rank = min(max(rank, 1), self.n)
+
+        return (rank - 1) * self._step % self.n + 1
+
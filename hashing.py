@@ -0,0 +1,100 @@
+"""Password hashing for Warbler, run off the request threads.
+
+bcrypt is deliberately slow, so hashing and checking run in a small process
+pool with a cap on how many may be waiting at once. When the cap is hit
+the request fails fast with a 503 instead of tying up a worker.
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_PENDING = 32
+
+
+class HashingBusy(ServiceUnavailable):
+    """Too many password hashes are already queued."""
+
+    description = "Too many logins in progress; please try again shortly."
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check_password(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """bcrypt hashing through a bounded process pool.
+
+    Configured from the app's PASSWORD_HASH_ROUNDS (bcrypt work factor),
+    PASSWORD_HASH_WORKERS (pool size; 0 hashes inline, e.g. for tests) and
+    PASSWORD_HASH_MAX_PENDING (queued + running hashes before HashingBusy).
+    """
+
+    def __init__(self):
+        self.rounds = DEFAULT_ROUNDS
+        self.workers = DEFAULT_WORKERS
+        self._slots = threading.BoundedSemaphore(DEFAULT_MAX_PENDING)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read hashing settings from `app.config`."""
+
+        config = app.config
+        self.rounds = config.setdefault('PASSWORD_HASH_ROUNDS', DEFAULT_ROUNDS)
+        self.workers = config.setdefault(
+            'PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+        self._slots = threading.BoundedSemaphore(config.setdefault(
+            'PASSWORD_HASH_MAX_PENDING', DEFAULT_MAX_PENDING))
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash_password, password.encode('UTF-8'), self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(
+            _check_password, password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?
+
+        bcrypt hashes look like $2b$<cost>$<salt+hash>.
+        """
+
+        return int(hashed.split('$')[2]) != self.rounds
+
+    def _run(self, func, *args):
+        """Run `func` in the pool, or raise HashingBusy if it's backed up."""
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy(retry_after=1)
+
+        try:
+            if not self.workers:
+                return func(*args)
+
+            return self._get_pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _get_pool(self):
+        # Started on first use, so each forked app server worker gets its own
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+            return self._pool
+
+
+password_hasher = PasswordHasher()
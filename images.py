@@ -0,0 +1,513 @@
+"""Resizing image proxy for profile pictures and header images.
+
+Users' image_url and header_image_url point at remote images, often huge
+(header images are 2070px-wide photos), which pages used to hot-link at
+full size. Templates now link them through
+
+    {{ thumbnail_url(user.image_url, 'avatar') }}
+
+giving /images/avatar/<signature>?url=<url>. On the first request for a
+URL the proxy fetches it once and keeps the original in IMAGE_CACHE_DIR;
+each size is resized from it the first time that size is requested, in
+the format that browser wants (WebP to browsers that accept it, JPEG to
+the rest), and served from disk after that, cached by the browser for a
+year (a changed picture is a new URL). The cache is capped at
+IMAGE_CACHE_MAX_BYTES, evicting the least recently served images first.
+
+The signature (an HMAC of size and URL with SECRET_KEY) keeps the proxy
+from fetching URLs our pages never linked. Origins on private, loopback
+and link-local addresses are refused unless IMAGE_PROXY_ALLOW_PRIVATE is
+set (as in tests), since image URLs come from users; the check happens
+as each connection is made, against the very address it connects to, so
+a host's DNS can't answer differently for the check and the fetch. When
+an image can't be fetched or decoded, the browser is redirected to the
+original URL, and the failure is remembered for
+IMAGE_FETCH_FAILURE_TTL seconds so a dead origin isn't hit by every
+page view in the meantime.
+
+Pillow does the resizing; without it the proxy still caches and serves
+the original bytes, just not resized.
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import logging
+import http.client
+import os
+import socket
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from flask import abort, redirect, request, send_file, url_for
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# name -> (max width, max height); images are scaled down to fit, keeping
+# their aspect ratio, and never scaled up
+SIZES = {
+    'avatar': (200, 200),
+    'card': (800, 400),
+    'hero': (1600, 600),
+}
+
+# (format, mimetype, extension); WebP only goes to browsers that list it
+# in Accept, everyone else gets JPEG
+WEBP = ('WEBP', 'image/webp', 'webp')
+JPEG = ('JPEG', 'image/jpeg', 'jpg')
+FORMATS = [WEBP, JPEG]
+
+QUALITY = 80
+
+ORIGINAL = 'original'
+
+DEFAULT_CACHE_MAX_BYTES = 1024 ** 3
+DEFAULT_FETCH_TIMEOUT = 5
+DEFAULT_FETCH_MAX_BYTES = 20 * 1024 ** 2
+DEFAULT_FETCH_FAILURE_TTL = 60
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class ImageFetchError(Exception):
+    """The origin image couldn't be fetched or decoded."""
+
+
+class ImageProxy:
+    """Disk cache of resized remote images, and the view serving it.
+
+    Configured from the app's IMAGE_PROXY (on/off), IMAGE_CACHE_DIR,
+    IMAGE_CACHE_MAX_BYTES, IMAGE_FETCH_TIMEOUT, IMAGE_FETCH_MAX_BYTES,
+    IMAGE_FETCH_FAILURE_TTL and IMAGE_PROXY_ALLOW_PRIVATE.
+    """
+
+    def __init__(self):
+        self.app = None
+        # {image key: bytes of its files}, least recently served first
+        self._images = None
+        self._total = 0
+        self._lock = threading.Lock()
+        # {url key: Lock} for fetches in progress
+        self._fetching = {}
+        # {url key: (monotonic expiry, error)} for recent failed fetches,
+        # soonest to expire first
+        self._failures = OrderedDict()
+
+    def init_app(self, app):
+        """Register the proxy view and the `thumbnail_url` template helper."""
+
+        self.app = app
+        app.config.setdefault('IMAGE_PROXY', True)
+        app.config.setdefault(
+            'IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+        app.config.setdefault('IMAGE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES)
+        app.config.setdefault('IMAGE_FETCH_TIMEOUT', DEFAULT_FETCH_TIMEOUT)
+        app.config.setdefault('IMAGE_FETCH_MAX_BYTES', DEFAULT_FETCH_MAX_BYTES)
+        app.config.setdefault(
+            'IMAGE_FETCH_FAILURE_TTL', DEFAULT_FETCH_FAILURE_TTL)
+        app.config.setdefault('IMAGE_PROXY_ALLOW_PRIVATE', False)
+
+        app.jinja_env.globals['thumbnail_url'] = self.thumbnail_url
+        app.add_url_rule(
+            '/images/<size>/<signature>', 'image_proxy', self.serve)
+
+    def thumbnail_url(self, url, size):
+        """URL serving remote image `url` resized to `size` (a SIZES name).
+
+        Other URLs (relative ones, say) come back unchanged, as does
+        everything with the proxy off.
+        """
+
+        if (not self.app.config['IMAGE_PROXY']
+                or urlsplit(url or '').scheme not in ('http', 'https')):
+            return url
+
+        return url_for(
+            'image_proxy', size=size, signature=self.sign(size, url), url=url)
+
+    def sign(self, size, url):
+        key = self.app.config['SECRET_KEY'].encode()
+        message = f"{size}\n{url}".encode()
+
+        return hmac.new(key, message, hashlib.sha256).hexdigest()[:32]
+
+    def serve(self, size, signature):
+        """The proxy view: the cached variant of the 'url' param at `size`
+        in the best format the browser accepts."""
+
+        url = request.args.get('url', '')
+
+        if (size not in SIZES
+                or not hmac.compare_digest(signature, self.sign(size, url))):
+            abort(404)
+
+        try:
+            path, mimetype = self.variant(url, size)
+        except ImageFetchError as error:
+            logger.warning("Image proxy can't use %s: %s", url, error)
+            return redirect(url)
+
+        response = send_file(
+            path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept')
+
+        return response
+
+    def variant(self, url, size):
+        """(path, mimetype) of the cached file for `url` at `size`,
+        fetching or resizing the image first if it isn't cached."""
+
+        key = hashlib.sha256(url.encode()).hexdigest()
+        found = self._cached(key, size)
+
+        if found is None:
+            with self._lock:
+                lock = self._fetching.setdefault(key, threading.Lock())
+
+            # one fetch per image, however many requests want it at once
+            try:
+                with lock:
+                    found = self._cached(key, size)
+
+                    if found is None:
+                        self._make(key, url, size)
+                        found = self._cached(key, size)
+            finally:
+                with self._lock:
+                    self._fetching.pop(key, None)
+
+            if found is None:
+                raise ImageFetchError("evicted as soon as stored")
+
+        return found
+
+    def _make(self, key, url, size):
+        """Store the variant of `url` at `size` that the browser accepts
+        under `key`, resized from the cached original or, if that isn't
+        cached, from a fresh fetch; unless fetching or decoding it failed
+        within the last IMAGE_FETCH_FAILURE_TTL seconds, which fails again
+        straight away."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            while self._failures:
+                expiry, _ = next(iter(self._failures.values()))
+
+                if expiry > now:
+                    break
+
+                self._failures.popitem(last=False)
+
+            failure = self._failures.get(key)
+            cached = key in self._index()
+
+        if failure is not None:
+            raise ImageFetchError(f"failed recently: {failure[1]}")
+
+        original = self._path(key, ORIGINAL, 'img')
+        files = {}
+        data = None
+
+        if cached:
+            try:
+                with open(original, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # evicted by another process sharing the directory
+                pass
+
+        try:
+            if data is None:
+                data = files[original] = self.fetch(url)
+
+            if Image is not None:
+                image_format, _, extension = self._format()
+                files[self._path(key, size, extension)] = self._resize(
+                    data, SIZES[size], image_format)
+
+            self._store(key, files)
+        except ImageFetchError as error:
+            expiry = (time.monotonic()
+                      + self.app.config['IMAGE_FETCH_FAILURE_TTL'])
+
+            with self._lock:
+                self._failures.pop(key, None)
+                self._failures[key] = (expiry, error)
+
+            raise
+
+    def _path(self, key, name, extension):
+        return os.path.join(
+            self.app.config['IMAGE_CACHE_DIR'], key[:2],
+            f"{key}-{name}.{extension}")
+
+    def _format(self):
+        """WEBP if the browser accepts it, else JPEG."""
+
+        return WEBP if WEBP[1] in request.accept_mimetypes.values() else JPEG
+
+    def _cached(self, key, size):
+        """(path, mimetype) of the cached file for `key` at `size` in the
+        format the browser accepts, marking the image recently used; or
+        None."""
+
+        with self._lock:
+            images = self._index()
+
+            if key not in images:
+                return None
+
+            images.move_to_end(key)
+
+        if Image is None:
+            path, mimetype = self._path(key, ORIGINAL, 'img'), None
+        else:
+            _, mimetype, extension = self._format()
+            path = self._path(key, size, extension)
+
+        try:
+            # mtimes keep the LRU order across restarts
+            os.utime(path)
+        except FileNotFoundError:
+            # not made yet, or evicted by another process sharing the
+            # directory
+            return None
+
+        return path, mimetype
+
+    def fetch(self, url):
+        """The image at `url`, as bytes."""
+
+        config = self.app.config
+        allow_private = config['IMAGE_PROXY_ALLOW_PRIVATE']
+        # straight to the origin (no proxies from the environment), over
+        # connections that check the address they connect to
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}),
+            _CheckedHTTPHandler(allow_private),
+            _CheckedHTTPSHandler(allow_private),
+            _CheckedRedirectHandler())
+
+        check_origin(url)
+
+        try:
+            with opener.open(url, timeout=config['IMAGE_FETCH_TIMEOUT']) as r:
+                data = r.read(config['IMAGE_FETCH_MAX_BYTES'] + 1)
+        except (OSError, ValueError) as error:
+            raise ImageFetchError(str(error)) from error
+
+        if len(data) > config['IMAGE_FETCH_MAX_BYTES']:
+            raise ImageFetchError("image too large")
+
+        return data
+
+    def _store(self, key, files):
+        """Write `files` ({path: bytes}) of image `key` to the cache,
+        evicting least recently used images to stay within
+        IMAGE_CACHE_MAX_BYTES."""
+
+        for path, data in files.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # written aside and renamed, so readers never see half a file
+            with open(f"{path}.{threading.get_ident()}.tmp", 'wb') as output:
+                output.write(data)
+
+            os.replace(output.name, path)
+
+        size = sum(len(data) for data in files.values())
+
+        with self._lock:
+            images = self._index()
+            stored = images.pop(key, 0)
+
+            # a freshly fetched original starts the image over; a variant
+            # adds to it
+            if self._path(key, ORIGINAL, 'img') not in files:
+                size += stored
+
+            self._total += size - stored
+            images[key] = size
+
+            # the image just stored stays, even if it alone is over the cap
+            while (self._total > self.app.config['IMAGE_CACHE_MAX_BYTES']
+                   and len(images) > 1):
+                evicted, evicted_size = images.popitem(last=False)
+                self._total -= evicted_size
+                self._remove(evicted)
+
+    def _resize(self, data, dimensions, image_format):
+        """Image `data` scaled down to fit `dimensions`, as `image_format`
+        bytes."""
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except (OSError, Image.DecompressionBombError) as error:
+            raise ImageFetchError(f"not an image: {error}") from error
+
+        image.thumbnail(dimensions)
+        # JPEG has no alpha channel
+        mode = 'RGB' if image_format == 'JPEG' else 'RGBA'
+        output = io.BytesIO()
+        image.convert(mode).save(output, image_format, quality=QUALITY)
+
+        return output.getvalue()
+
+    def _remove(self, key):
+        """Delete the cached files of image `key`."""
+
+        folder = os.path.join(self.app.config['IMAGE_CACHE_DIR'], key[:2])
+
+        for name in os.listdir(folder):
+            if name.startswith(key):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def _index(self):
+        """{image key: bytes} of the images in the cache directory, least
+        recently used first; built on first use from the files on disk.
+        Call with the lock held."""
+
+        if self._images is None:
+            found = {}
+
+            for root, _, names in os.walk(self.app.config['IMAGE_CACHE_DIR']):
+                for name in names:
+                    if name.endswith('.tmp'):
+                        continue
+
+                    stat = os.stat(os.path.join(root, name))
+                    key = name.split('-')[0]
+                    used, size = found.get(key, (0, 0))
+                    found[key] = (
+                        max(used, stat.st_mtime), size + stat.st_size)
+
+            self._images = OrderedDict(
+                (key, size)
+                for key, (_, size) in sorted(
+                    found.items(), key=lambda item: item[1][0]))
+            self._total = sum(self._images.values())
+
+        return self._images
+
+    def clear(self):
+        """Forget the cache index (the files stay until evicted) and
+        recent failures."""
+
+        with self._lock:
+            self._images = None
+            self._total = 0
+            self._failures.clear()
+
+
+def check_origin(url):
+    """Refuse URLs that aren't http(s)."""
+
+    parts = urlsplit(url)
+
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageFetchError("not an http(s) URL")
+
+
+def origin_addresses(host, port, allow_private=False):
+    """The IP addresses `host` resolves to, refusing hosts with a private,
+    loopback or otherwise internal one."""
+
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as error:
+        raise ImageFetchError(str(error)) from error
+
+    found = list(dict.fromkeys(sockaddr[0] for *_, sockaddr in addresses))
+
+    if not allow_private:
+        for address in found:
+            if not ipaddress.ip_address(address).is_global:
+                raise ImageFetchError(f"{host} is an internal address")
+
+    return found
+
+
+class _CheckedConnection:
+    """http.client connection mixin that connects to an address
+    `origin_addresses` allowed, rather than resolving the host again.
+
+    The host name still goes in the Host header and, over TLS, in SNI and
+    the certificate check.
+    """
+
+    def __init__(self, *args, allow_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allow_private = allow_private
+        # http.client's hook for opening the socket
+        self._create_connection = self._connect_checked
+
+    def _connect_checked(self, address, timeout, source_address=None):
+        host, port = address
+        error = None
+
+        for ip in origin_addresses(host, port, self.allow_private):
+            try:
+                return socket.create_connection(
+                    (ip, port), timeout, source_address)
+            except OSError as failure:
+                error = failure
+
+        raise error
+
+
+class _CheckedHTTPConnection(_CheckedConnection, http.client.HTTPConnection):
+    pass
+
+
+class _CheckedHTTPSConnection(_CheckedConnection, http.client.HTTPSConnection):
+    pass
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def http_open(self, req):
+        return self.do_open(
+            _CheckedHTTPConnection, req, allow_private=self.allow_private)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, allow_private):
+        super().__init__()
+        self.allow_private = allow_private
+
+    def https_open(self, req):
+        return self.do_open(
+            _CheckedHTTPSConnection, req, context=self._context,
+            allow_private=self.allow_private)
+
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects only to http(s) URLs; their connections are
+    checked like the first one."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_origin(newurl)
+
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+image_proxy = ImageProxy()
@@ -0,0 +1,35 @@
+"""username prefix index
+
+Expression index on lower(username) for prefix searches, which
+autogenerate can't render; text_pattern_ops lets PostgreSQL use it for
+LIKE 'abc%' regardless of collation. It comes after the revisions that
+alter users, since SQLite's batch table rebuilds can't carry an
+expression index over.
+
+Revision ID: 2b9f4d6a8e13
+Revises: 9e6b3f1c4a72
+Create Date: 2026-10-18 09:17:05.318824
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2b9f4d6a8e13'
+down_revision = '9e6b3f1c4a72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(
+            'CREATE INDEX ix_users_username_lower '
+            'ON users (lower(username) text_pattern_ops)')
+    else:
+        op.execute(
+            'CREATE INDEX ix_users_username_lower ON users (lower(username))')
+
+
+def downgrade():
+    op.drop_index('ix_users_username_lower', table_name='users')
@@ -0,0 +1,62 @@
+"""timeline entries
+
+The precomputed home timelines (see models.TimelineEntry), filled with
+each user's TIMELINE_LENGTH most recent messages by themselves and the
+users they follow.
+
+Revision ID: 5a1d7c2e9b04
+Revises: 3f6a1c9d2e47
+Create Date: 2026-10-18 09:14:02.771930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1d7c2e9b04'
+down_revision = '3f6a1c9d2e47'
+branch_labels = None
+depends_on = None
+
+# models.TIMELINE_LENGTH when this revision was written
+TIMELINE_LENGTH = 100
+
+
+def upgrade():
+    op.create_table('timeline_entries',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('owner_id', 'message_id')
+    )
+    op.create_index('ix_timeline_entries_owner_timestamp', 'timeline_entries', ['owner_id', 'timestamp'], unique=False)
+
+    op.execute(f"""
+        INSERT INTO timeline_entries (owner_id, message_id, author_id, timestamp)
+        SELECT owner_id, id, user_id, timestamp
+        FROM (
+            SELECT candidates.*, row_number() OVER (
+                PARTITION BY owner_id ORDER BY timestamp DESC, id DESC
+            ) AS position
+            FROM (
+                SELECT user_id AS owner_id, id, user_id, timestamp
+                FROM messages
+                UNION ALL
+                SELECT follows.user_following_id, messages.id,
+                       messages.user_id, messages.timestamp
+                FROM messages
+                JOIN follows
+                  ON follows.user_being_followed_id = messages.user_id
+            ) AS candidates
+        ) AS ranked
+        WHERE position <= {TIMELINE_LENGTH}""")
+
+
+def downgrade():
+    op.drop_index('ix_timeline_entries_owner_timestamp', table_name='timeline_entries')
+    op.drop_table('timeline_entries')
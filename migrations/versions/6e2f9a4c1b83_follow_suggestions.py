@@ -0,0 +1,86 @@
+"""follow suggestions
+
+The precomputed "who to follow" table (see models.FollowSuggestion),
+filled with each user's SUGGESTIONS_KEPT best friends of friends, a
+batch of users per statement.
+
+Revision ID: 6e2f9a4c1b83
+Revises: d41c7e3b9a60
+Create Date: 2026-10-18 16:05:23.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2f9a4c1b83'
+down_revision = 'd41c7e3b9a60'
+branch_labels = None
+depends_on = None
+
+# models.SUGGESTIONS_KEPT and REBUILD_BATCH_SIZE when this revision was
+# written
+SUGGESTIONS_KEPT = 20
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.create_table('follow_suggestions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('suggested_id', sa.Integer(), nullable=False),
+    sa.Column('mutuals', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['suggested_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'suggested_id')
+    )
+    op.create_index('ix_follow_suggestions_suggested', 'follow_suggestions', ['suggested_id'], unique=False)
+
+    connection = op.get_bind()
+    backfill = sa.text(f"""
+        INSERT INTO follow_suggestions (user_id, suggested_id, mutuals)
+        SELECT user_id, suggested_id, mutuals
+        FROM (
+            SELECT via.user_following_id AS user_id,
+                   onward.user_being_followed_id AS suggested_id,
+                   count(*) AS mutuals,
+                   row_number() OVER (
+                       PARTITION BY via.user_following_id
+                       ORDER BY count(*) DESC, onward.user_being_followed_id
+                   ) AS position
+            FROM follows AS via
+            JOIN follows AS onward
+              ON onward.user_following_id = via.user_being_followed_id
+            JOIN users ON users.id = onward.user_being_followed_id
+            WHERE via.user_following_id BETWEEN :first AND :last
+              AND onward.user_being_followed_id != via.user_following_id
+              AND users.deleted_at IS NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM follows
+                  WHERE follows.user_following_id = via.user_following_id
+                    AND follows.user_being_followed_id
+                        = onward.user_being_followed_id)
+            GROUP BY via.user_following_id, onward.user_being_followed_id
+        ) AS ranked
+        WHERE position <= {SUGGESTIONS_KEPT}""")
+
+    # user ids a batch at a time, so no one statement walks two hops of
+    # the whole follow graph
+    after = 0
+
+    while True:
+        user_ids = connection.execute(sa.text(
+            "SELECT id FROM users WHERE id > :after ORDER BY id LIMIT :limit"
+        ), dict(after=after, limit=BATCH_SIZE)).scalars().all()
+
+        if not user_ids:
+            break
+
+        connection.execute(
+            backfill, dict(first=user_ids[0], last=user_ids[-1]))
+        after = user_ids[-1]
+
+
+def downgrade():
+    op.drop_index('ix_follow_suggestions_suggested', table_name='follow_suggestions')
+    op.drop_table('follow_suggestions')
@@ -0,0 +1,35 @@
+"""user updated_at
+
+Row version stamp behind pages' ETag/Last-Modified; existing rows start
+at the time of the upgrade.
+
+Revision ID: 7d4a2c8e1f59
+Revises: 8c3e5f1a7d26
+Create Date: 2026-10-18 09:18:44.650172
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4a2c8e1f59'
+down_revision = '8c3e5f1a7d26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite can't ADD COLUMN with a non-constant default, so it gets the
+    # table rebuilt instead
+    recreate = 'always' if op.get_bind().dialect.name == 'sqlite' else 'auto'
+
+    with op.batch_alter_table('users', recreate=recreate) as batch_op:
+        batch_op.add_column(sa.Column(
+            'updated_at', sa.DateTime(), server_default=sa.func.now(),
+            nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('updated_at')
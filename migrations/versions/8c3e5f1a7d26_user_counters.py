@@ -0,0 +1,46 @@
+"""user counters
+
+Denormalized message/follow/like counts on users, computed here for
+existing rows; the server default starts new rows (including ones
+inserted around the ORM) at zero.
+
+Revision ID: 8c3e5f1a7d26
+Revises: 5a1d7c2e9b04
+Create Date: 2026-10-18 09:15:37.204418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3e5f1a7d26'
+down_revision = '5a1d7c2e9b04'
+branch_labels = None
+depends_on = None
+
+# counter column -> (table, column counted)
+COUNTERS = {
+    'messages_count': ('messages', 'user_id'),
+    'following_count': ('follows', 'user_following_id'),
+    'followers_count': ('follows', 'user_being_followed_id'),
+    'likes_count': ('likes', 'user_id'),
+}
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        for name in COUNTERS:
+            batch_op.add_column(sa.Column(
+                name, sa.Integer(), server_default='0', nullable=False))
+
+    op.execute("UPDATE users SET " + ", ".join(
+        f"{name} = (SELECT count(*) FROM {table} "
+        f"WHERE {table}.{column} = users.id)"
+        for name, (table, column) in COUNTERS.items()))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        for name in reversed(list(COUNTERS)):
+            batch_op.drop_column(name)
@@ -0,0 +1,40 @@
+"""account deletion
+
+users.deleted_at, which hides an account at once, and the deletion_jobs
+that purge its rows in the background (see models.DeletionJob).
+
+Revision ID: 9e6b3f1c4a72
+Revises: 7d4a2c8e1f59
+Create Date: 2026-10-18 09:20:13.092655
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e6b3f1c4a72'
+down_revision = '7d4a2c8e1f59'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    op.create_table('deletion_jobs',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('stage', sa.String(length=20), nullable=False),
+    sa.Column('rows_deleted', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('deletion_jobs')
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('deleted_at')
@@ -0,0 +1,42 @@
+"""hot path indexes
+
+Secondary indexes for the queries behind profiles, feeds, follow lists
+and likers. On PostgreSQL they're built CONCURRENTLY (outside the
+migration's transaction), so the tables stay writable while they build.
+
+Revision ID: b8e0c2f4d915
+Revises: 2b9f4d6a8e13
+Create Date: 2026-10-18 09:31:07.118402
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e0c2f4d915'
+down_revision = '2b9f4d6a8e13'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_user_timestamp', 'messages', ['user_id', 'timestamp', 'id']),
+    ('ix_follows_following', 'follows', ['user_following_id', 'user_being_followed_id']),
+    ('ix_likes_message', 'likes', ['message_id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(
+                    name, table, columns, unique=False,
+                    postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
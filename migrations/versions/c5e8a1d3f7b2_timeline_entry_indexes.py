@@ -0,0 +1,40 @@
+"""timeline entry indexes
+
+Indexes on timeline_entries beyond its owner's timeline order, built
+CONCURRENTLY on PostgreSQL like b8e0c2f4d915_hot_path_indexes.py.
+
+Revision ID: c5e8a1d3f7b2
+Revises: 6e2f9a4c1b83
+Create Date: 2026-10-18 17:42:19.536087
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8a1d3f7b2'
+down_revision = '6e2f9a4c1b83'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_timeline_entries_message', 'timeline_entries', ['message_id']),
+    ('ix_timeline_entries_author', 'timeline_entries', ['author_id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(
+                    name, table, columns, unique=False,
+                    postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
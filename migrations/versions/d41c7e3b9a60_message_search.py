@@ -0,0 +1,69 @@
+"""message search
+
+The full-text index behind /messages/search (see models.MessageSearch):
+on PostgreSQL a table of tsvectors with a GIN index, on SQLite an FTS5
+table over messages.text kept up to date by triggers. Existing messages
+are indexed here; the GIN index is built after the backfill, which is
+much faster than maintaining it row by row.
+
+Revision ID: d41c7e3b9a60
+Revises: b8e0c2f4d915
+Create Date: 2026-10-18 14:12:40.552170
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c7e3b9a60'
+down_revision = 'b8e0c2f4d915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("""
+            CREATE TABLE message_search (
+                message_id INTEGER PRIMARY KEY
+                    REFERENCES messages (id) ON DELETE CASCADE,
+                user_id INTEGER NOT NULL,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                document TSVECTOR NOT NULL
+            )""")
+        op.execute("""
+            INSERT INTO message_search (message_id, user_id, timestamp, document)
+            SELECT id, user_id, timestamp, to_tsvector('english', text)
+            FROM messages""")
+        op.execute("""
+            CREATE INDEX ix_message_search_document
+                ON message_search USING gin (document)""")
+        op.execute("""
+            CREATE INDEX ix_message_search_user_timestamp
+                ON message_search (user_id, timestamp)""")
+    else:
+        op.execute("""
+            CREATE VIRTUAL TABLE message_search
+                USING fts5(text, content='messages', content_rowid='id')""")
+        op.execute("""
+            CREATE TRIGGER message_search_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO message_search (rowid, text)
+                VALUES (new.id, new.text);
+            END""")
+        op.execute("""
+            CREATE TRIGGER message_search_delete AFTER DELETE ON messages
+            BEGIN
+                INSERT INTO message_search (message_search, rowid, text)
+                VALUES ('delete', old.id, old.text);
+            END""")
+        op.execute(
+            "INSERT INTO message_search (message_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.execute("DROP TRIGGER message_search_insert")
+        op.execute("DROP TRIGGER message_search_delete")
+
+    op.execute("DROP TABLE message_search")
@@ -1,12 +1,25 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import (
+    aliased, joinedload, lazyload, make_transient_to_detached, raiseload,
+    with_loader_criteria)
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import password_hasher
+from replicas import RoutingSession
+from pagination import (
+    Page, MESSAGES_PER_PAGE, encode_message_cursor, encode_search_cursor,
+    paginate_messages)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -17,6 +30,73 @@ DEFAULT_HEADER_IMAGE_URL = (
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
     "mat&fit=crop&w=2070&q=80")
 
+# Most results a username search returns
+SEARCH_LIMIT = 60
+
+# How many message ids we keep in each user's precomputed home timeline
+TIMELINE_LENGTH = 100
+
+# How many follow suggestions we keep for each user, best first, and how
+# many of those the home page shows
+SUGGESTIONS_KEPT = 20
+SUGGESTIONS_SHOWN = 5
+
+# How many users' derived rows (timelines, suggestions) a rebuild computes
+# and commits at a time
+REBUILD_BATCH_SIZE = 1000
+
+
+def no_lazy_loads():
+    """Loader option for relationships a query didn't ask to load.
+
+    With RAISE_ON_LAZY_LOAD set (as in tests) touching one raises, so a
+    stray lazy load in a hot path's template fails loudly; otherwise they
+    lazy load as usual.
+    """
+
+    if current_app.config.get('RAISE_ON_LAZY_LOAD'):
+        return raiseload('*')
+
+    return lazyload('*')
+
+
+def dialect_insert(model):
+    """INSERT into `model`'s table with the current database's ON CONFLICT
+    support, on PostgreSQL or SQLite."""
+
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+    return insert(model)
+
+
+def insert_ignoring_conflicts(model):
+    """INSERT into `model`'s table that skips rows whose key already
+    exists (ON CONFLICT DO NOTHING), on PostgreSQL or SQLite."""
+
+    return dialect_insert(model).on_conflict_do_nothing()
+
+
+def user_id_batches(batch_size):
+    """Every user id, ascending, in lists of up to `batch_size`: for work
+    done (and committed) a batch of users at a time."""
+
+    after = 0
+
+    while True:
+        user_ids = db.session.scalars(
+            db.select(User.id)
+            .where(User.id > after)
+            .order_by(User.id)
+            .limit(batch_size)
+        ).all()
+
+        if not user_ids:
+            return
+
+        yield user_ids
+        after = user_ids[-1]
+
 
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -35,6 +115,100 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # The primary key leads with the followed user, which serves
+        # follower lists; this one serves "who does X follow" (following
+        # lists, feeds, follow checks).
+        db.Index(
+            'ix_follows_following', user_following_id, user_being_followed_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? A primary-key lookup."""
+
+        return db.session.scalar(
+            db.select(db.exists().where(
+                cls.user_being_followed_id == followed_id,
+                cls.user_following_id == follower_id)))
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`; False if they already
+        did. A single INSERT, no collections loaded."""
+
+        return bool(cls.add_many([(follower_id, followed_id)]))
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Make `follower_id` stop following `followed_id`; False if they
+        weren't. A single DELETE, no collections loaded."""
+
+        return bool(cls.remove_many([(follower_id, followed_id)]))
+
+    @classmethod
+    def add_many(cls, pairs):
+        """Record follows for (follower_id, followed_id) `pairs`, skipping
+        ones that already exist, in one statement; return the pairs added.
+
+        Timelines and follow counters are updated for the added ones.
+        """
+
+        if not pairs:
+            return []
+
+        added = db.session.execute(
+            insert_ignoring_conflicts(cls)
+            .values([
+                dict(user_following_id=follower, user_being_followed_id=followed)
+                for follower, followed in pairs
+            ])
+            .returning(cls.user_following_id, cls.user_being_followed_id)
+        ).all()
+
+        for follower, followed in added:
+            TimelineEntry.backfill(follower, followed)
+            FollowSuggestion.follow_added(follower, followed)
+
+        User.adjust_counts_each(
+            'following_count', Counter(follower for follower, _ in added))
+        User.adjust_counts_each(
+            'followers_count', Counter(followed for _, followed in added))
+
+        return [tuple(row) for row in added]
+
+    @classmethod
+    def remove_many(cls, pairs):
+        """Delete follows for (follower_id, followed_id) `pairs` in one
+        statement; return the pairs that existed.
+
+        Timelines and follow counters are updated for the removed ones.
+        """
+
+        if not pairs:
+            return []
+
+        removed = db.session.execute(
+            db.delete(cls)
+            .where(db.tuple_(
+                cls.user_following_id, cls.user_being_followed_id).in_(pairs))
+            .returning(cls.user_following_id, cls.user_being_followed_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        for follower, followed in removed:
+            TimelineEntry.purge(follower, followed)
+            FollowSuggestion.follow_removed(follower, followed)
+
+        User.adjust_counts_each(
+            'following_count', Counter(follower for follower, _ in removed),
+            sign=-1)
+        User.adjust_counts_each(
+            'followers_count', Counter(followed for _, followed in removed),
+            sign=-1)
+
+        return [tuple(row) for row in removed]
+
 class Like(db.Model):
     """which user liked which message("warble")."""
 
@@ -51,6 +225,521 @@ class Like(db.Model):
         primary_key=True
     )
 
+    __table_args__ = (
+        # For a message's likers (`liked_by`), and the cascade when a
+        # message is deleted.
+        db.Index('ix_likes_message', message_id),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Make `user_id` like `message_id`; False if they already did.
+        A single INSERT, no collections loaded."""
+
+        return bool(cls.add_many([(user_id, message_id)]))
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Make `user_id` unlike `message_id`; False if they didn't like
+        it. A single DELETE, no collections loaded."""
+
+        return bool(cls.remove_many([(user_id, message_id)]))
+
+    @classmethod
+    def add_many(cls, pairs):
+        """Record likes for (user_id, message_id) `pairs`, skipping ones that
+        already exist, in one statement; return the pairs added.
+
+        likes_count is updated for the added ones.
+        """
+
+        if not pairs:
+            return []
+
+        added = db.session.execute(
+            insert_ignoring_conflicts(cls)
+            .values([
+                dict(user_id=user_id, message_id=message_id)
+                for user_id, message_id in pairs
+            ])
+            .returning(cls.user_id, cls.message_id)
+        ).all()
+
+        User.adjust_counts_each(
+            'likes_count', Counter(user_id for user_id, _ in added))
+
+        return [tuple(row) for row in added]
+
+    @classmethod
+    def remove_many(cls, pairs):
+        """Delete likes for (user_id, message_id) `pairs` in one statement;
+        return the pairs that existed.
+
+        likes_count is updated for the removed ones.
+        """
+
+        if not pairs:
+            return []
+
+        removed = db.session.execute(
+            db.delete(cls)
+            .where(db.tuple_(cls.user_id, cls.message_id).in_(pairs))
+            .returning(cls.user_id, cls.message_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        User.adjust_counts_each(
+            'likes_count', Counter(user_id for user_id, _ in removed),
+            sign=-1)
+
+        return [tuple(row) for row in removed]
+
+
+class TimelineEntry(db.Model):
+    """A message id pushed into a user's home timeline.
+
+    Each user's timeline is a capped list of the most recent messages by
+    themselves and the users they follow, written when a message is added
+    (fan-out-on-write) so the homepage can read it without scanning
+    `messages`. `author_id` and `timestamp` are copied from the message so
+    unfollowing and ordering don't need a join.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_owner_timestamp', owner_id, timestamp),
+        # For the cascade when a message is deleted, which otherwise scans
+        # every timeline.
+        db.Index('ix_timeline_entries_message', message_id),
+        # For purging a deleted account's messages from everyone's
+        # timelines, and the cascade when the user row goes.
+        db.Index('ix_timeline_entries_author', author_id),
+    )
+
+    @classmethod
+    def push(cls, message):
+        """Fan `message` out to its author's and their followers' timelines.
+
+        The message must already be flushed so it has an id.
+        """
+
+        owners = (db.select(Follow.user_following_id.label('owner_id'))
+                  .where(Follow.user_being_followed_id == message.user_id)
+                  .union_all(db.select(db.literal(message.user_id)))
+                  .subquery())
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['owner_id', 'message_id', 'author_id', 'timestamp'],
+                db.select(
+                    owners.c.owner_id,
+                    db.literal(message.id),
+                    db.literal(message.user_id),
+                    db.literal(message.timestamp, db.DateTime))))
+
+        cls.trim(db.select(owners.c.owner_id))
+
+    @classmethod
+    def remove(cls, message_id):
+        """Remove a message from every timeline it was pushed into."""
+
+        db.session.execute(db.delete(cls).where(cls.message_id == message_id))
+
+    @classmethod
+    def backfill(cls, owner_id, author_id):
+        """Add `author_id`'s recent messages to `owner_id`'s timeline.
+
+        Used when `owner_id` starts following `author_id`.
+        """
+
+        recent = (db.select(
+            db.literal(owner_id),
+            Message.id,
+            Message.user_id,
+            Message.timestamp)
+            .where(Message.user_id == author_id)
+            .order_by(Message.timestamp.desc())
+            .limit(TIMELINE_LENGTH))
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['owner_id', 'message_id', 'author_id', 'timestamp'],
+                recent))
+
+        cls.trim(db.select(db.literal(owner_id)))
+
+    @classmethod
+    def purge(cls, owner_id, author_id):
+        """Drop `author_id`'s messages from `owner_id`'s timeline.
+
+        Used when `owner_id` stops following `author_id`.
+        """
+
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.owner_id == owner_id, cls.author_id == author_id))
+
+    @classmethod
+    def trim(cls, owner_ids):
+        """Cap the timelines of `owner_ids` (a select of ids) at
+        TIMELINE_LENGTH entries, dropping the oldest."""
+
+        ranked = (db.select(
+            cls.owner_id,
+            cls.message_id,
+            db.func.row_number().over(
+                partition_by=cls.owner_id,
+                order_by=(cls.timestamp.desc(), cls.message_id.desc()),
+            ).label('position'))
+            .where(cls.owner_id.in_(owner_ids))
+            .subquery())
+
+        overflow = (db.select(ranked.c.owner_id, ranked.c.message_id)
+                    .where(ranked.c.position > TIMELINE_LENGTH))
+
+        db.session.execute(
+            db.delete(cls)
+            .where(db.tuple_(cls.owner_id, cls.message_id).in_(overflow)))
+
+    @classmethod
+    def rebuild(cls, batch_size=REBUILD_BATCH_SIZE):
+        """Recompute every user's timeline from `messages` and `follows`,
+        `batch_size` owners at a time, committing after each batch.
+
+        For use after bulk loads (see seed.py), which bypass fan-out.
+        """
+
+        db.session.execute(db.delete(cls))
+        db.session.commit()
+
+        for owner_ids in user_id_batches(batch_size):
+            cls._rebuild_owners(owner_ids)
+            db.session.commit()
+
+    @classmethod
+    def _rebuild_owners(cls, owner_ids):
+        """Fill the (empty) timelines of `owner_ids`.
+
+        Each author an owner reads (themselves and whoever they follow)
+        contributes just their latest TIMELINE_LENGTH messages, a short
+        walk of ix_messages_user_timestamp; those are then ranked and cut
+        to TIMELINE_LENGTH per owner.
+        """
+
+        sources = db.union_all(
+            db.select(User.id.label('owner_id'), User.id.label('author_id'))
+            .where(User.id.in_(owner_ids)),
+            db.select(Follow.user_following_id, Follow.user_being_followed_id)
+            .where(Follow.user_following_id.in_(owner_ids)),
+        ).subquery()
+
+        authors = db.select(sources.c.author_id).distinct().subquery()
+        newest_first = (Message.timestamp.desc(), Message.id.desc())
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            latest = (db.select(Message.id, Message.user_id, Message.timestamp)
+                      .where(Message.user_id == authors.c.author_id)
+                      .order_by(*newest_first)
+                      .limit(TIMELINE_LENGTH)
+                      .lateral())
+            latest = (db.select(latest)
+                      .select_from(authors)
+                      .join(latest, db.true())
+                      .subquery())
+        else:
+            # no LATERAL: rank each author's messages instead
+            numbered = (db.select(
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+                db.func.row_number().over(
+                    partition_by=Message.user_id, order_by=newest_first,
+                ).label('position'))
+                .where(Message.user_id.in_(db.select(authors)))
+                .subquery())
+            latest = (db.select(
+                numbered.c.id, numbered.c.user_id, numbered.c.timestamp)
+                .where(numbered.c.position <= TIMELINE_LENGTH)
+                .subquery())
+
+        candidates = (db.select(sources.c.owner_id, latest)
+                      .join(latest, latest.c.user_id == sources.c.author_id)
+                      .subquery())
+
+        ranked = (db.select(
+            candidates,
+            db.func.row_number().over(
+                partition_by=candidates.c.owner_id,
+                order_by=(candidates.c.timestamp.desc(),
+                          candidates.c.id.desc()),
+            ).label('position'))
+            .subquery())
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['owner_id', 'message_id', 'author_id', 'timestamp'],
+                db.select(
+                    ranked.c.owner_id,
+                    ranked.c.id,
+                    ranked.c.user_id,
+                    ranked.c.timestamp)
+                .where(ranked.c.position <= TIMELINE_LENGTH)))
+
+
+class FollowSuggestion(db.Model):
+    """An account suggested for a user to follow ("who to follow").
+
+    Suggestions are friends of friends: users followed by the users
+    `user_id` follows, scored by `mutuals`, the number of those in
+    between. Only the SUGGESTIONS_KEPT best are kept per user, so serving
+    them is one short primary-key range read rather than a walk over two
+    hops of the follow graph on every page view.
+
+    `rebuild` computes them from scratch (`flask rebuild-suggestions`
+    runs it in batches of users). In between, Follow.add_many and
+    remove_many only adjust the follower's own rows, a bounded amount of
+    work per follow: the followed user stops being suggested, and the
+    path through them is added to (or taken off) the scores of the first
+    SUGGESTIONS_KEPT users they follow. Everyone else's suggestions, and
+    scores the bounds cut short, wait for the periodic rebuild.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    mutuals = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # For dropping a user from everyone's suggestions (account
+        # deletion, and the cascade when the user row goes).
+        db.Index('ix_follow_suggestions_suggested', suggested_id),
+    )
+
+    @classmethod
+    def top(cls, query, user_id, limit):
+        """`user_id`'s best `limit` suggestions, best first.
+
+        `query` selects from User what to fetch for each suggested user
+        (User objects with loader options, or columns); rows come back
+        with `mutuals` added.
+        """
+
+        return (query
+                .add_columns(cls.mutuals)
+                .join(cls, cls.suggested_id == User.id)
+                .filter(cls.user_id == user_id)
+                .order_by(cls.mutuals.desc(), cls.suggested_id)
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def scores(cls, user_ids=None):
+        """Select (user_id, suggested_id, mutuals) for every friend of a
+        friend of `user_ids` (or of every user) that they don't already
+        follow."""
+
+        via = aliased(Follow)
+        onward = aliased(Follow)
+        follower = via.user_following_id
+        suggested = onward.user_being_followed_id
+
+        already_following = db.select(Follow).where(
+            Follow.user_following_id == follower,
+            Follow.user_being_followed_id == suggested)
+
+        query = (
+            db.select(
+                follower.label('user_id'),
+                suggested.label('suggested_id'),
+                db.func.count().label('mutuals'))
+            .join_from(via, onward,
+                       onward.user_following_id == via.user_being_followed_id)
+            .join(User, User.id == suggested)
+            .where(suggested != follower,
+                   User.deleted_at.is_(None),
+                   ~already_following.exists())
+            .group_by(follower, suggested))
+
+        if user_ids is not None:
+            query = query.where(follower.in_(user_ids))
+
+        return query
+
+    @classmethod
+    def refresh(cls, user_ids=None):
+        """Recompute the suggestions of `user_ids`, or of every user."""
+
+        if user_ids is not None:
+            user_ids = list(user_ids)
+
+            if not user_ids:
+                return
+
+        delete = db.delete(cls)
+
+        if user_ids is not None:
+            delete = delete.where(cls.user_id.in_(user_ids))
+
+        db.session.execute(delete.execution_options(synchronize_session=False))
+
+        scores = cls.scores(user_ids).subquery()
+
+        ranked = (db.select(
+            scores,
+            db.func.row_number().over(
+                partition_by=scores.c.user_id,
+                order_by=(scores.c.mutuals.desc(), scores.c.suggested_id),
+            ).label('position'))
+            .subquery())
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'suggested_id', 'mutuals'],
+                db.select(
+                    ranked.c.user_id, ranked.c.suggested_id, ranked.c.mutuals)
+                .where(ranked.c.position <= SUGGESTIONS_KEPT)))
+
+    @classmethod
+    def rebuild(cls, batch_size=REBUILD_BATCH_SIZE):
+        """Recompute everyone's suggestions, `batch_size` users at a time,
+        committing after each batch; return the number of users. For
+        bulk loads (see seed.py) and `flask rebuild-suggestions`."""
+
+        users = 0
+
+        for user_ids in user_id_batches(batch_size):
+            cls.refresh(user_ids)
+            db.session.commit()
+            users += len(user_ids)
+
+        return users
+
+    @classmethod
+    def onward(cls, user_id):
+        """Select the ids of the users a follow of `user_id` leads on to,
+        as far as incremental updates go: the first SUGGESTIONS_KEPT it
+        follows in id order (which is also how `rebuild` breaks ties), a
+        short walk of ix_follows_following."""
+
+        return (db.select(Follow.user_being_followed_id.label('id'))
+                .where(Follow.user_following_id == user_id)
+                .order_by(Follow.user_being_followed_id)
+                .limit(SUGGESTIONS_KEPT))
+
+    @classmethod
+    def follow_added(cls, follower_id, followed_id):
+        """Adjust `follower_id`'s own suggestions for their new follow of
+        `followed_id`: drop it as a suggestion, and score the new paths
+        through it (see `onward`)."""
+
+        onward = cls.onward(followed_id).subquery()
+
+        already_following = db.select(Follow).where(
+            Follow.user_following_id == follower_id,
+            Follow.user_being_followed_id == onward.c.id)
+
+        paths = (
+            db.select(db.literal(follower_id), onward.c.id, db.literal(1))
+            .join(User, User.id == onward.c.id)
+            .where(onward.c.id != follower_id,
+                   User.deleted_at.is_(None),
+                   ~already_following.exists()))
+
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == follower_id, cls.suggested_id == followed_id)
+            .execution_options(synchronize_session=False))
+
+        db.session.execute(
+            dialect_insert(cls)
+            .from_select(['user_id', 'suggested_id', 'mutuals'], paths)
+            .on_conflict_do_update(
+                index_elements=[cls.user_id, cls.suggested_id],
+                set_=dict(mutuals=cls.mutuals + 1)))
+
+        cls.trim([follower_id])
+
+    @classmethod
+    def follow_removed(cls, follower_id, followed_id):
+        """Take the lost paths through `followed_id` (the same ones
+        `follow_added` scored) off the scores of `follower_id`'s own
+        suggestions."""
+
+        mine = db.and_(cls.user_id == follower_id,
+                       cls.suggested_id.in_(cls.onward(followed_id)))
+
+        db.session.execute(
+            db.update(cls)
+            .where(mine)
+            .values(mutuals=cls.mutuals - 1)
+            .execution_options(synchronize_session=False))
+
+        db.session.execute(
+            db.delete(cls)
+            .where(mine, cls.mutuals <= 0)
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def trim(cls, user_ids):
+        """Cap the suggestions of `user_ids` (a select of ids) at
+        SUGGESTIONS_KEPT, dropping the lowest scored."""
+
+        ranked = (db.select(
+            cls.user_id,
+            cls.suggested_id,
+            db.func.row_number().over(
+                partition_by=cls.user_id,
+                order_by=(cls.mutuals.desc(), cls.suggested_id),
+            ).label('position'))
+            .where(cls.user_id.in_(user_ids))
+            .subquery())
+
+        overflow = (db.select(ranked.c.user_id, ranked.c.suggested_id)
+                    .where(ranked.c.position > SUGGESTIONS_KEPT))
+
+        db.session.execute(
+            db.delete(cls)
+            .where(db.tuple_(cls.user_id, cls.suggested_id).in_(overflow))
+            .execution_options(synchronize_session=False))
+
 
 class User(db.Model):
     """User in the system."""
@@ -103,8 +792,70 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts for profile headers, kept current by the write
+    # paths in app.py via `adjust_counts` and repaired with `recount`. The
+    # server default covers rows inserted around the ORM (seed.py's COPY).
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the account is deleted; the row (and everything hanging off
+    # it) is purged later by a DeletionJob, and hidden from queries until
+    # then.
+
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Bumped by every change to the row, counters included, so it versions
+    # everything a profile shows; pages use it for ETag/Last-Modified.
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
     messages = db.relationship('Message', backref="user")
 
+    __table_args__ = (
+        # Lets username searches walk an index by prefix; text_pattern_ops
+        # makes PostgreSQL use it for LIKE 'abc%' regardless of collation.
+        db.Index(
+            'ix_users_username_lower',
+            db.func.lower(username).label('username_lower'),
+            postgresql_ops={'username_lower': 'text_pattern_ops'},
+        ),
+    )
+
     likes = db.relationship('Message', secondary="likes", backref="liked_by")
 
     followers = db.relationship(
@@ -125,7 +876,7 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -147,30 +898,181 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the hash was made with a different bcrypt cost than is now
+        configured, it's upgraded in the session; the caller commits.
         """
 
         user = cls.query.filter_by(username=username).one_or_none()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's? Rehashes at the configured
+        cost if it does and the stored hash is outdated."""
+
+        if not password_hasher.check(self.password, password):
+            return False
+
+        if password_hasher.needs_rehash(self.password):
+            self.password = password_hasher.hash(password)
+
+        return True
+
+    def column_values(self):
+        """Snapshot of this user's column values, e.g. for caching."""
+
+        return {
+            attr.key: getattr(self, attr.key)
+            for attr in self.__mapper__.column_attrs
+        }
+
+    @classmethod
+    def from_column_values(cls, values):
+        """Attach a user built from a `column_values` snapshot to the
+        session without querying the database.
+
+        Changes to it are flushed as usual; relationships still lazy load.
+        """
+
+        user = cls(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @classmethod
+    def card_loader(cls):
+        """Loader profile for lists of user cards: columns only."""
+
+        return (no_lazy_loads(),)
+
+    @classmethod
+    def search(cls, term, limit=SEARCH_LIMIT):
+        """Find users whose username starts with `term` (case-insensitive).
+
+        Results come back in username order, so an exact match ranks first,
+        and are capped at `limit`. Matching is a prefix range over the
+        lower(username) index rather than a '%term%' scan; PostgreSQL gets
+        an escaped LIKE (which it runs as an index range with
+        text_pattern_ops), other databases an explicit range.
+        """
+
+        term = term.strip().lower()
+        key = db.func.lower(cls.username)
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            escaped = (term.replace("\\", "\\\\")
+                       .replace("%", "\\%")
+                       .replace("_", "\\_"))
+            match = key.like(f"{escaped}%", escape="\\")
+        else:
+            match = db.and_(key >= term, key < term + "\U0010ffff")
+
+        return (cls.query
+                .filter(match)
+                .options(*cls.card_loader())
+                .order_by(key)
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` (e.g. followers_count=1) to the counters of users.
+
+        `user_ids` is an id, a list of ids or a select of ids. Done as a
+        single UPDATE so concurrent writers can't lose increments.
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(user_ids))
+            .values({
+                name: getattr(cls, name) + delta
+                for name, delta in deltas.items()
+            })
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def adjust_counts_each(cls, name, counts, sign=1):
+        """Add `sign` * counts[user_id] to counter `name` of each user in
+        `counts` (a Counter of user ids), one UPDATE per distinct amount."""
+
+        by_amount = {}
+
+        for user_id, count in counts.items():
+            by_amount.setdefault(sign * count, []).append(user_id)
+
+        for amount, user_ids in by_amount.items():
+            cls.adjust_counts(user_ids, **{name: amount})
+
+    @classmethod
+    def recount(cls, user_ids=None):
+        """Recompute the counters of `user_ids` (or of every user).
+
+        Used to repair drift and after bulk loads that skip the write paths.
+        """
+
+        def count(column):
+            return (db.select(db.func.count())
+                    .where(column == cls.id)
+                    .scalar_subquery())
+
+        stmt = db.update(cls).values(
+            messages_count=count(Message.user_id),
+            following_count=count(Follow.user_following_id),
+            followers_count=count(Follow.user_being_followed_id),
+            likes_count=count(Like.user_id),
+        ).execution_options(synchronize_session=False)
+
+        if user_ids is not None:
+            stmt = stmt.where(cls.id.in_(user_ids))
+
+        db.session.execute(stmt)
+
+    def liked_ids_among(self, message_ids):
+        """Return the set of `message_ids` this user has liked.
+
+        One query for a whole page of messages, so templates can check
+        like state with a set lookup instead of scanning `self.likes`.
+        """
+
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Like.message_id)
+            .where(Like.user_id == self.id,
+                   Like.message_id.in_(message_ids))))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follow.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follow.exists(self.id, other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Return the set of `user_ids` this user follows.
+
+        One query for a whole page of user cards, so templates can check
+        follow state with a set lookup.
+        """
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == self.id,
+                   Follow.user_being_followed_id.in_(user_ids))))
 
 
 class Message(db.Model):
@@ -200,6 +1102,481 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        # A user's messages newest first, in the (timestamp, id) order
+        # pages are keyed on: profiles, timeline backfill, older feed pages.
+        db.Index('ix_messages_user_timestamp', user_id, timestamp, id),
+    )
+
+    @classmethod
+    def list_loader(cls):
+        """Loader profile for message lists that show each author: authors
+        come in the same query (a join), nothing else loads."""
+
+        return (
+            joinedload(cls.user, innerjoin=True).options(no_lazy_loads()),
+            no_lazy_loads(),
+        )
+
+    @classmethod
+    def bare_loader(cls):
+        """Loader profile for message lists of a single, known author:
+        columns only."""
+
+        return (no_lazy_loads(),)
+
+    @classmethod
+    def feed_page(cls, query, user_id, before):
+        """Return a newest-first Page of `user_id`'s home feed.
+
+        `query` selects what to fetch for each message (Message objects
+        with loader options, or columns including Message.id and
+        Message.timestamp); `before` is a decoded message cursor.
+
+        Reads the user's precomputed timeline. The timeline is capped, so
+        once it runs out this keeps paging through older messages of
+        followed users directly, keying past the timeline's last entry.
+        """
+
+        page = paginate_messages(
+            query
+            .join(TimelineEntry, TimelineEntry.message_id == cls.id)
+            .filter(TimelineEntry.owner_id == user_id),
+            TimelineEntry.timestamp,
+            TimelineEntry.message_id,
+            before)
+
+        if page.next_cursor is not None:
+            return page
+
+        if len(page.items) == MESSAGES_PER_PAGE:
+            return Page(page.items, encode_message_cursor(page.items[-1]))
+
+        if page.items:
+            before = (page.items[-1].timestamp, page.items[-1].id)
+
+        # a join against the authors (rather than user_id IN followed OR
+        # user_id = me, which planners run as a scan of messages) so each
+        # author's messages are read off ix_messages_user_timestamp
+        authors = (db.select(Follow.user_being_followed_id.label('author_id'))
+                   .where(Follow.user_following_id == user_id)
+                   .union_all(db.select(db.literal(user_id)))
+                   .subquery())
+
+        older = paginate_messages(
+            query.join(authors, authors.c.author_id == cls.user_id),
+            cls.timestamp,
+            cls.id,
+            before,
+            MESSAGES_PER_PAGE - len(page.items))
+
+        return Page(page.items + older.items, older.next_cursor)
+
+
+class MessageSearch:
+    """Full-text index of message text.
+
+    Not an ORM model: its table depends on the database, and is created
+    and dropped along with `messages` (see the DDL below) and by the
+    migrations.
+
+    On PostgreSQL, `message_search` holds each message's tsvector, with a
+    GIN index for matching, plus the author and time for filtering without
+    touching `messages`. On SQLite (local runs) it's an FTS5 table over
+    `messages.text`.
+
+    On PostgreSQL, `add` indexes a new message; on SQLite, triggers do
+    (an FTS5 table over another table must see every change to it, or
+    its index goes bad). `rebuild` reindexes everything, after bulk
+    loads. Entries go away with their messages in the database itself (a
+    cascading foreign key on PostgreSQL, a trigger on SQLite), so they
+    follow every delete, including user deletion.
+    """
+
+    TABLE = 'message_search'
+
+    # text search configuration (stemming, stop words) on PostgreSQL
+    CONFIG = 'english'
+
+    pg_table = db.table(
+        TABLE,
+        db.column('message_id'),
+        db.column('user_id'),
+        db.column('timestamp'),
+        db.column('document'),
+    )
+
+    fts_table = db.table(TABLE, db.column('rowid'))
+
+    @classmethod
+    def _is_postgres(cls):
+        return db.session.get_bind().dialect.name == 'postgresql'
+
+    @classmethod
+    def add(cls, message):
+        """Index `message`, which must already be flushed."""
+
+        if cls._is_postgres():
+            db.session.execute(db.insert(cls.pg_table).values(
+                message_id=message.id,
+                user_id=message.user_id,
+                timestamp=message.timestamp,
+                document=db.func.to_tsvector(cls.CONFIG, message.text)))
+
+    @classmethod
+    def rebuild(cls):
+        """Reindex every message, e.g. after a bulk load (see seed.py)."""
+
+        if cls._is_postgres():
+            db.session.execute(db.delete(cls.pg_table))
+            db.session.execute(db.insert(cls.pg_table).from_select(
+                ['message_id', 'user_id', 'timestamp', 'document'],
+                db.select(
+                    Message.id,
+                    Message.user_id,
+                    Message.timestamp,
+                    db.func.to_tsvector(cls.CONFIG, Message.text))))
+        else:
+            db.session.execute(db.text(
+                f"INSERT INTO {cls.TABLE}({cls.TABLE}) VALUES ('rebuild')"))
+
+    @classmethod
+    def search(cls, terms, author=None, since=None, until=None, after=None,
+               per_page=MESSAGES_PER_PAGE):
+        """Return a Page of ids of messages matching `terms`, best first.
+
+        `terms` is what the user typed: words, which must all match (by
+        stem, on PostgreSQL, which also takes "quoted phrases" and
+        -excluded words). Results can be limited to messages by username
+        `author` (case-insensitive) and from date `since` to date `until`,
+        inclusive. `after` is a decoded search cursor.
+
+        Matches come from the inverted index, so the work grows with the
+        number of matching messages rather than of all messages. They're
+        ranked by ts_rank on PostgreSQL and bm25 on SQLite, and pages are
+        keyed on (rank, id) rather than an OFFSET.
+        """
+
+        if not terms or not terms.strip():
+            return Page([], None)
+
+        if cls._is_postgres():
+            query = db.func.websearch_to_tsquery(cls.CONFIG, terms)
+            table = cls.pg_table.c
+            columns = (table.message_id, table.user_id, table.timestamp)
+            # ts_rank is a float4, which loses digits once it reaches the
+            # client as a page cursor and compares against that; a float8
+            # round-trips exactly
+            rank = db.cast(
+                db.func.ts_rank(table.document, query), db.Float(53))
+            matches = (
+                db.select(columns[0].label('id'), rank.label('rank'))
+                .where(table.document.op('@@')(query)))
+        else:
+            query = cls.fts_query(terms)
+
+            if query is None:
+                return Page([], None)
+
+            table = db.literal_column(cls.TABLE)
+            columns = (Message.id, Message.user_id, Message.timestamp)
+            rank = -db.func.bm25(table)
+            matches = (
+                db.select(columns[0].label('id'), rank.label('rank'))
+                .join_from(cls.fts_table, Message,
+                           Message.id == cls.fts_table.c.rowid)
+                .where(table.op('MATCH')(query)))
+
+        _, author_id, timestamp = columns
+
+        if author:
+            matches = matches.where(author_id == (
+                db.select(User.id)
+                .where(db.func.lower(User.username) == author.strip().lower())
+                .scalar_subquery()))
+        if since is not None:
+            matches = matches.where(timestamp >= since)
+        if until is not None:
+            matches = matches.where(timestamp < until + timedelta(days=1))
+
+        ranked = matches.subquery()
+        query = db.select(ranked.c.id, ranked.c.rank)
+
+        if after:
+            query = query.where(db.tuple_(ranked.c.rank, ranked.c.id) < after)
+
+        rows = db.session.execute(
+            query
+            .order_by(ranked.c.rank.desc(), ranked.c.id.desc())
+            .limit(per_page + 1)
+        ).all()
+
+        ids = [row.id for row in rows[:per_page]]
+
+        if len(rows) > per_page:
+            last = rows[per_page - 1]
+            return Page(ids, encode_search_cursor(last.rank, last.id))
+
+        return Page(ids, None)
+
+    @staticmethod
+    def fts_query(terms):
+        """FTS5 query matching every word of `terms`, or None if it has
+        none. Words are quoted, so FTS5 syntax typed by users is just text.
+        """
+
+        words = re.findall(r'\w+', terms)
+
+        if not words:
+            return None
+
+        return ' '.join(f'"{word}"' for word in words)
+
+
+# The search table's schema differs per database, so it's created and
+# dropped with `messages` rather than declared in the metadata (the
+# migrations create it too; see include_in_migrations).
+
+event.listen(Message.__table__, 'after_create', DDL(f"""
+    CREATE TABLE {MessageSearch.TABLE} (
+        message_id INTEGER PRIMARY KEY
+            REFERENCES messages (id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        document TSVECTOR NOT NULL
+    );
+    CREATE INDEX ix_{MessageSearch.TABLE}_document
+        ON {MessageSearch.TABLE} USING gin (document);
+    CREATE INDEX ix_{MessageSearch.TABLE}_user_timestamp
+        ON {MessageSearch.TABLE} (user_id, timestamp)
+""").execute_if(dialect='postgresql'))
+
+event.listen(Message.__table__, 'after_create', DDL(f"""
+    CREATE VIRTUAL TABLE {MessageSearch.TABLE}
+        USING fts5(text, content='messages', content_rowid='id')
+""").execute_if(dialect='sqlite'))
+
+event.listen(Message.__table__, 'after_create', DDL(f"""
+    CREATE TRIGGER {MessageSearch.TABLE}_insert AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO {MessageSearch.TABLE} (rowid, text)
+        VALUES (new.id, new.text);
+    END
+""").execute_if(dialect='sqlite'))
+
+event.listen(Message.__table__, 'after_create', DDL(f"""
+    CREATE TRIGGER {MessageSearch.TABLE}_delete AFTER DELETE ON messages
+    BEGIN
+        INSERT INTO {MessageSearch.TABLE} ({MessageSearch.TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END
+""").execute_if(dialect='sqlite'))
+
+event.listen(Message.__table__, 'before_drop', DDL(
+    f"DROP TABLE IF EXISTS {MessageSearch.TABLE}"))
+
+
+def include_in_migrations(name, type_, parent_names):
+    """Alembic include_name hook: leave the search tables (see
+    MessageSearch), which aren't in the metadata, out of autogenerate."""
+
+    return not (type_ == 'table' and name.startswith(MessageSearch.TABLE))
+
+
+class DeletionJob(db.Model):
+    """Purge of a deleted account's rows, a bounded batch at a time.
+
+    Deleting a big account in one transaction would hold locks on hot
+    tables for as long as it takes, so `delete_user` only hides the user
+    (User.deleted_at) and records a job. The job then removes the user's
+    timeline entries, likes (theirs and on their messages), follows,
+    follow suggestions, messages and finally the user row, in that order,
+    committing after every batch. `stage` and `rows_deleted` record
+    progress; every step is idempotent, so a job interrupted by a crash
+    just runs again from its current stage.
+    """
+
+    __tablename__ = 'deletion_jobs'
+
+    STAGES = (
+        'timelines', 'likes', 'follows', 'suggestions', 'messages', 'user')
+    DONE = 'done'
+
+    # no foreign key: the job outlives the user row it deletes
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    stage = db.Column(
+        db.String(20),
+        nullable=False,
+        default=STAGES[0],
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    @classmethod
+    def start(cls, user):
+        """Hide `user` from now on and queue the purge of their rows.
+        The caller commits."""
+
+        user.deleted_at = datetime.utcnow()
+        db.session.merge(cls(
+            user_id=user.id,
+            stage=cls.STAGES[0],
+            rows_deleted=0,
+            created_at=user.deleted_at,
+            finished_at=None))
+
+    @classmethod
+    def pending(cls):
+        """Jobs not finished yet, oldest first."""
+
+        return (cls.query
+                .filter(cls.stage != cls.DONE)
+                .order_by(cls.created_at)
+                .all())
+
+    def run(self, batch_size, pause=0):
+        """Run batches, committing after each (and sleeping `pause`
+        seconds between them), until the job is done."""
+
+        while self.stage != self.DONE:
+            self.run_batch(batch_size)
+            db.session.commit()
+
+            if pause:
+                time.sleep(pause)
+
+    def run_batch(self, batch_size):
+        """Delete up to `batch_size` rows for the current stage, moving to
+        the next stage once it runs dry. Returns the rows deleted; the
+        caller commits."""
+
+        deleted = getattr(self, f'_purge_{self.stage}')(batch_size)
+        self.rows_deleted += deleted
+
+        if deleted < batch_size:
+            position = self.STAGES.index(self.stage) + 1
+
+            if position < len(self.STAGES):
+                self.stage = self.STAGES[position]
+            else:
+                self.stage = self.DONE
+                self.finished_at = datetime.utcnow()
+
+        return deleted
+
+    def _own_message_ids(self):
+        return db.select(Message.id).where(Message.user_id == self.user_id)
+
+    def _purge_timelines(self, batch_size):
+        # their own timeline, then their messages in everyone else's: one
+        # delete per column, so each walks that column's index
+        deleted = 0
+
+        for column in (TimelineEntry.owner_id, TimelineEntry.author_id):
+            if deleted == batch_size:
+                break
+
+            batch = (db.select(
+                TimelineEntry.owner_id, TimelineEntry.message_id)
+                .where(column == self.user_id)
+                .limit(batch_size - deleted))
+
+            deleted += db.session.execute(
+                db.delete(TimelineEntry)
+                .where(db.tuple_(
+                    TimelineEntry.owner_id,
+                    TimelineEntry.message_id).in_(batch))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        return deleted
+
+    def _purge_likes(self, batch_size):
+        # through Like.remove_many, so the likers' counters follow
+        pairs = db.session.execute(
+            db.select(Like.user_id, Like.message_id)
+            .where(db.or_(Like.user_id == self.user_id,
+                          Like.message_id.in_(self._own_message_ids())))
+            .limit(batch_size)
+        ).all()
+
+        return len(Like.remove_many([tuple(pair) for pair in pairs]))
+
+    def _purge_follows(self, batch_size):
+        # through Follow.remove_many, so timelines and counters follow
+        pairs = db.session.execute(
+            db.select(Follow.user_following_id, Follow.user_being_followed_id)
+            .where(db.or_(Follow.user_following_id == self.user_id,
+                          Follow.user_being_followed_id == self.user_id))
+            .limit(batch_size)
+        ).all()
+
+        return len(Follow.remove_many([tuple(pair) for pair in pairs]))
+
+    def _purge_suggestions(self, batch_size):
+        batch = (db.select(
+            FollowSuggestion.user_id, FollowSuggestion.suggested_id)
+            .where(db.or_(FollowSuggestion.user_id == self.user_id,
+                          FollowSuggestion.suggested_id == self.user_id))
+            .limit(batch_size))
+
+        return db.session.execute(
+            db.delete(FollowSuggestion)
+            .where(db.tuple_(
+                FollowSuggestion.user_id,
+                FollowSuggestion.suggested_id).in_(batch))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+    def _purge_messages(self, batch_size):
+        return db.session.execute(
+            db.delete(Message)
+            .where(Message.id.in_(self._own_message_ids().limit(batch_size)))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+    def _purge_user(self, batch_size):
+        return db.session.execute(
+            db.delete(User)
+            .where(User.id == self.user_id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _hide_deleted_users(execute_state):
+    """Leave deleted users (and so their messages, which are loaded with
+    their author) out of ORM queries, unless run with the
+    `include_deleted` execution option."""
+
+    if (execute_state.is_select
+            and not execute_state.is_column_load
+            and not execute_state.is_relationship_load
+            and not execute_state.execution_options.get('include_deleted')):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(
+                User, User.deleted_at.is_(None), include_aliases=True))
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,133 @@
+"""Keyset (cursor) pagination helpers for Warbler.
+
+Pages are fetched with `WHERE (sort columns) < cursor ORDER BY ... LIMIT n`
+rather than OFFSET, so every page costs the same no matter how deep it is.
+"""
+
+from datetime import date, datetime
+from typing import NamedTuple
+
+from sqlalchemy import tuple_
+from werkzeug.exceptions import BadRequest
+
+MESSAGES_PER_PAGE = 50
+USERS_PER_PAGE = 60
+
+CURSOR_SEPARATOR = "_"
+
+
+class Page(NamedTuple):
+    """One page of results and the cursor for the page after it (or None)."""
+
+    items: list
+    next_cursor: str | None
+
+
+def encode_message_cursor(message):
+    """Cursor pointing just past `message` in newest-first order."""
+
+    return f"{message.timestamp.isoformat()}{CURSOR_SEPARATOR}{message.id}"
+
+
+def decode_message_cursor(cursor):
+    """Parse a message cursor into (timestamp, id); None if not given."""
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, message_id = cursor.rsplit(CURSOR_SEPARATOR, 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except ValueError:
+        raise BadRequest("Invalid page cursor.")
+
+
+def decode_user_cursor(cursor):
+    """Parse a user cursor (the last user id seen); None if not given."""
+
+    if not cursor:
+        return None
+
+    try:
+        return int(cursor)
+    except ValueError:
+        raise BadRequest("Invalid page cursor.")
+
+
+def encode_search_cursor(rank, message_id):
+    """Cursor pointing just past a search result in best-first order."""
+
+    return f"{rank!r}{CURSOR_SEPARATOR}{message_id}"
+
+
+def decode_search_cursor(cursor):
+    """Parse a search cursor into (rank, id); None if not given."""
+
+    if not cursor:
+        return None
+
+    try:
+        rank, message_id = cursor.rsplit(CURSOR_SEPARATOR, 1)
+        return float(rank), int(message_id)
+    except ValueError:
+        raise BadRequest("Invalid page cursor.")
+
+
+def decode_date(value):
+    """Parse a YYYY-MM-DD query arg; None if not given."""
+
+    if not value:
+        return None
+
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest("Invalid date.")
+
+
+def in_order(items, ids):
+    """`items` (anything with an .id) sorted as `ids` lists them, for
+    hydrating a page of ids ranked by something other than a column."""
+
+    position = {item_id: i for i, item_id in enumerate(ids)}
+
+    return sorted(items, key=lambda item: position[item.id])
+
+
+def paginate_messages(query, timestamp_col, id_col, before,
+                      per_page=MESSAGES_PER_PAGE):
+    """Return a newest-first Page of messages from `query`.
+
+    `timestamp_col` and `id_col` are the columns to key on (usually
+    Message.timestamp and Message.id); `before` is a decoded message cursor.
+    """
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < before)
+
+    items = (query
+             .order_by(timestamp_col.desc(), id_col.desc())
+             .limit(per_page + 1)
+             .all())
+
+    if len(items) > per_page:
+        return Page(items[:per_page], encode_message_cursor(items[per_page - 1]))
+
+    return Page(items, None)
+
+
+def paginate_users(query, id_col, after, per_page=USERS_PER_PAGE):
+    """Return a Page of users from `query` in ascending id order.
+
+    `after` is a decoded user cursor.
+    """
+
+    if after:
+        query = query.filter(id_col > after)
+
+    items = query.order_by(id_col).limit(per_page + 1).all()
+
+    if len(items) > per_page:
+        return Page(items[:per_page], str(items[per_page - 1].id))
+
+    return Page(items, None)
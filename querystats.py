@@ -0,0 +1,227 @@
+"""Per-request SQL statistics for Warbler.
+
+Counts the statements each request sends to the database and the time they
+take, reports them in response headers and the log, and warns about the
+same statement running over and over in one request (usually an N+1 lazy
+load in a template loop).
+
+For tests there are `assert_max_queries`, a query budget, and
+`assert_no_table_scans`, which EXPLAINs the statements a block ran.
+"""
+
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPEAT_THRESHOLD = 3
+
+# QueryStats collecting outside of requests, see `assert_max_queries`
+_collectors = []
+
+
+class QueryStats:
+    """Statements run, and time spent in the database, for one unit of work."""
+
+    def __init__(self, keep_parameters=False):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        # (statement, parameters) of each SELECT, if `keep_parameters`
+        self.selects = [] if keep_parameters else None
+
+    def record(self, statement, duration, parameters=None):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+        if (self.selects is not None
+                and statement.lstrip().upper().startswith('SELECT')):
+            self.selects.append((statement, parameters))
+
+    def repeated(self, threshold=DEFAULT_REPEAT_THRESHOLD):
+        """{statement: times run} for statements run `threshold`+ times."""
+
+        return {
+            statement: times
+            for statement, times in self.statements.items()
+            if times >= threshold
+        }
+
+    def report(self):
+        """Multi-line summary of statements, most frequent first."""
+
+        return "\n".join(
+            f"{times} x {statement}"
+            for statement, times in self.statements.most_common())
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+
+    if has_app_context() and 'query_stats' in g:
+        g.query_stats.record(statement, duration)
+
+    for stats in _collectors:
+        stats.record(statement, duration, parameters)
+
+
+def init_app(app):
+    """Collect stats for every request of `app`.
+
+    With QUERY_STATS_HEADERS set, responses carry X-DB-Query-Count,
+    X-DB-Time-Ms and a Server-Timing entry; X-DB-Repeated-Queries appears
+    when some statement ran QUERY_REPEAT_THRESHOLD or more times.
+    """
+
+    app.config.setdefault('QUERY_STATS_HEADERS', True)
+    app.config.setdefault('QUERY_REPEAT_THRESHOLD', DEFAULT_REPEAT_THRESHOLD)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop('query_stats', None)
+
+        if stats is None:
+            return response
+
+        repeated = stats.repeated(app.config['QUERY_REPEAT_THRESHOLD'])
+        duration_ms = round(stats.duration * 1000, 2)
+
+        logger.debug(
+            "db_queries=%d db_time_ms=%.2f", stats.count, duration_ms)
+
+        for statement, times in repeated.items():
+            logger.warning(
+                "Possible N+1: statement ran %d times in one request: %s",
+                times, statement)
+
+        if app.config['QUERY_STATS_HEADERS']:
+            response.headers['X-DB-Query-Count'] = str(stats.count)
+            response.headers['X-DB-Time-Ms'] = str(duration_ms)
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={duration_ms};desc="{stats.count} queries"')
+
+            if repeated:
+                response.headers['X-DB-Repeated-Queries'] = str(
+                    sum(repeated.values()))
+
+        return response
+
+
+@contextmanager
+def assert_max_queries(max_queries):
+    """Fail if the block runs more than `max_queries` statements.
+
+    For tests, e.g.:
+
+        with assert_max_queries(5):
+            client.get("/")
+    """
+
+    stats = QueryStats()
+    _collectors.append(stats)
+
+    try:
+        yield stats
+    finally:
+        _collectors.remove(stats)
+
+    if stats.count > max_queries:
+        raise AssertionError(
+            f"{stats.count} queries run, budget was {max_queries}:\n"
+            f"{stats.report()}")
+
+
+# SQLite plan steps that read a whole table: "SCAN messages", a walk of all
+# of one of its indexes ("SCAN follows USING COVERING INDEX ..."), or a
+# skip-scan, which walks every value of an index's leading column
+# ("SEARCH follows USING INDEX ... (ANY(user_being_followed_id) AND ...)")
+_SQLITE_TABLE_SCAN = re.compile(r'^SCAN (\w+)\b')
+_SQLITE_SKIP_SCAN = re.compile(r'^SEARCH (\w+)\b.*\(ANY\(')
+
+
+def table_scans(connection, statement, parameters=()):
+    """Names of tables the database's plan for `statement` reads in full
+    (sequential scans), on PostgreSQL or SQLite."""
+
+    if connection.dialect.name == 'postgresql':
+        [[plan]] = connection.exec_driver_sql(
+            f"EXPLAIN (FORMAT JSON) {statement}", parameters).all()
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        scans = []
+        nodes = [plan[0]['Plan']]
+
+        while nodes:
+            node = nodes.pop()
+            nodes += node.get('Plans', [])
+
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+
+        return scans
+
+    rows = connection.exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+
+    return [
+        match.group(1)
+        for *_, detail in rows
+        if (match := (_SQLITE_TABLE_SCAN.match(detail)
+                      or _SQLITE_SKIP_SCAN.match(detail)))
+    ]
+
+
+@contextmanager
+def assert_no_table_scans(engine, tables):
+    """Fail if the plan of any SELECT the block runs reads one of `tables`
+    in full.
+
+    For tests on a seeded, ANALYZEd database, e.g.:
+
+        with assert_no_table_scans(db.engine, ['messages']):
+            client.get("/")
+    """
+
+    stats = QueryStats(keep_parameters=True)
+    _collectors.append(stats)
+
+    try:
+        yield stats
+    finally:
+        _collectors.remove(stats)
+
+    failures = []
+
+    with engine.connect() as connection:
+        for statement, parameters in stats.selects:
+            scanned = set(table_scans(connection, statement, parameters))
+
+            if scanned & set(tables):
+                failures.append(
+                    f"{', '.join(sorted(scanned & set(tables)))}: {statement}")
+
+    if failures:
+        raise AssertionError(
+            "table scans in query plans:\n" + "\n".join(failures))
@@ -0,0 +1,104 @@
+"""Read-replica routing for Warbler.
+
+With DATABASE_REPLICA_URLS set, queries made while handling a GET or HEAD
+request go to one of the replicas (picked at random, once per request).
+Everything else stays on the primary: other requests, flushes and
+INSERT/UPDATE/DELETE statements even during a GET, and anything outside a
+request such as CLI commands and background threads.
+
+Replicas lag the primary, so a browser that just made a write (any
+non-GET request) reads from the primary for the next
+REPLICA_STICKY_SECONDS, and sees its own changes. The deadline lives in
+the session cookie, so it holds across workers.
+"""
+
+import random
+import time
+
+import sqlalchemy as sa
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+DEFAULT_STICKY_SECONDS = 5
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+
+class RoutingSession(Session):
+    """Session that sends a request's reads to the replica chosen for it."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not _is_write(clause):
+            replica = replica_router.current()
+
+            if replica is not None:
+                return replica
+
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _is_write(clause):
+    return isinstance(clause, sa.sql.dml.UpdateBase)
+
+
+class ReplicaRouter:
+    """Replica engines and the per-request choice between them.
+
+    Configured from the app's DATABASE_REPLICA_URLS (a list of database
+    URLs; replica engines share SQLALCHEMY_ENGINE_OPTIONS with the primary)
+    and REPLICA_STICKY_SECONDS.
+    """
+
+    def __init__(self):
+        self.engines = []
+
+    def init_app(self, app):
+        """Create replica engines and route each request."""
+
+        app.config.setdefault('DATABASE_REPLICA_URLS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+
+        self.configure(
+            app.config['DATABASE_REPLICA_URLS'],
+            app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+        @app.before_request
+        def choose_replica():
+            g.pop('replica', None)
+
+            if (self.engines
+                    and request.method in SAFE_METHODS
+                    and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()):
+                g.replica = random.choice(self.engines)
+
+        @app.after_request
+        def stick_to_primary(response):
+            if request.method not in SAFE_METHODS and self.engines:
+                session[PRIMARY_UNTIL_KEY] = (
+                    time.time() + app.config['REPLICA_STICKY_SECONDS'])
+
+            return response
+
+    def configure(self, urls, engine_options=None):
+        """Replace the replica engines with ones for `urls` (none: every
+        query goes to the primary)."""
+
+        for engine in self.engines:
+            engine.dispose()
+
+        self.engines = [
+            sa.create_engine(url, **(engine_options or {})) for url in urls
+        ]
+
+    def current(self):
+        """The replica engine for the current request, or None."""
+
+        if not has_request_context():
+            return None
+
+        return g.get('replica')
+
+
+replica_router = ReplicaRouter()
@@ -1,19 +1,219 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Streams each CSV into its table in fixed-size batches, committing after
+every batch: PostgreSQL gets COPY, other databases (e.g. SQLite) a plain
+executemany. Secondary indexes (and, on PostgreSQL, foreign keys) are
+dropped for the load and rebuilt once at the end, which is much faster
+than maintaining them row by row.
+
+Run it like:
+
+    python seed.py                      # rebuild the schema and load
+    python seed.py --batch-size 50000   # bigger batches for big loads
+    python seed.py --resume             # carry on after a crash
+
+The schema is rebuilt by running the migrations (see migrations/), so a
+seeded database is one `flask db upgrade` can carry forward.
+
+Since each batch commits on its own, a table's row count says how many of
+its CSV rows are already in; --resume skips those and keeps going.
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+
+from flask_migrate import upgrade
+from sqlalchemy import inspect
+from sqlalchemy.schema import AddConstraint, CreateIndex, DropIndex
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follow, Like
+from models import (
+    User, Message, MessageSearch, Follow, FollowSuggestion, Like, TimelineEntry)
+
+DEFAULT_DATA_DIR = 'generator'
+DEFAULT_BATCH_SIZE = 10_000
+
+# Loaded in this order, so rows only ever point at rows already loaded
+CSV_FILES = [
+    (User, 'users.csv'),
+    (Message, 'messages.csv'),
+    (Follow, 'follows.csv'),
+    (Like, 'likes.csv'),
+]
+
+
+def batches(rows, size):
+    """Yield lists of up to `size` items from iterable `rows`."""
+
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def copy_batch(table, columns, batch):
+    """Load `batch` (lists of CSV values) with PostgreSQL COPY."""
+
+    # quoted, so empty strings stay empty strings (COPY reads an unquoted
+    # empty field as NULL); the counter columns COPY doesn't list start at
+    # their server default
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(batch)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def insert_batch(table, columns, batch):
+    """Load `batch` (lists of CSV values) with executemany."""
+
+    def convert(column, value):
+        if isinstance(table.c[column].type, db.DateTime):
+            return datetime.fromisoformat(value)
+        return value
+
+    db.session.execute(
+        db.insert(table),
+        [
+            {column: convert(column, value)
+             for column, value in zip(columns, row)}
+            for row in batch
+        ])
+
+
+def defer_constraints(tables):
+    """Drop secondary indexes (and foreign keys on PostgreSQL) of `tables`.
+
+    `restore_constraints` puts them back after the load.
+    """
+
+    bind = db.session.connection()
+
+    for table in tables:
+        for index in table.indexes:
+            bind.execute(DropIndex(index, if_exists=True))
+
+        if bind.dialect.name == 'postgresql':
+            for fk in inspect(bind).get_foreign_keys(table.name):
+                bind.exec_driver_sql(
+                    f'ALTER TABLE {table.name} DROP CONSTRAINT "{fk["name"]}"')
+
+    db.session.commit()
+
+
+def restore_constraints(tables):
+    """Recreate what `defer_constraints` dropped."""
+
+    bind = db.session.connection()
+
+    for table in tables:
+        for index in table.indexes:
+            bind.execute(CreateIndex(index, if_not_exists=True))
+
+        if bind.dialect.name == 'postgresql':
+            existing = {
+                tuple(fk['constrained_columns'])
+                for fk in inspect(bind).get_foreign_keys(table.name)
+            }
+            for fk in table.foreign_key_constraints:
+                if tuple(fk.column_keys) not in existing:
+                    bind.execute(AddConstraint(fk))
+
+    db.session.commit()
+
+
+def reset_schema():
+    """Drop every table, then build the schema from the migrations."""
+
+    db.drop_all()
+    db.session.execute(db.text("DROP TABLE IF EXISTS alembic_version"))
+    db.session.commit()
+    upgrade()
+
+
+def load_csv(model, path, batch_size, resume):
+    """Stream the CSV at `path` into `model`'s table; return rows loaded."""
+
+    table = model.__table__
+    is_postgres = db.session.get_bind().dialect.name == 'postgresql'
+    load_batch = copy_batch if is_postgres else insert_batch
+
+    skip = db.session.query(model).count() if resume else 0
+    loaded = 0
+    started = time.perf_counter()
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        for _ in range(skip):
+            next(reader, None)
+
+        for batch in batches(reader, batch_size):
+            load_batch(table, columns, batch)
+            db.session.commit()
+
+            loaded += len(batch)
+            elapsed = time.perf_counter() - started
+            print(f"  {table.name}: {skip + loaded:,} rows "
+                  f"({loaded / elapsed:,.0f} rows/sec)", end="\r")
+
+    elapsed = time.perf_counter() - started
+    print(f"  {table.name}: {loaded:,} rows loaded, {skip:,} skipped "
+          f"in {elapsed:.1f}s ({loaded / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    return loaded
+
+
+def seed(data_dir=DEFAULT_DATA_DIR, batch_size=DEFAULT_BATCH_SIZE,
+         resume=False):
+    """Load every CSV found in `data_dir`, then build derived data."""
+
+    if not resume:
+        reset_schema()
+
+    tables = db.metadata.sorted_tables
+    defer_constraints(tables)
+
+    for model, filename in CSV_FILES:
+        path = os.path.join(data_dir, filename)
+
+        if os.path.exists(path):
+            load_csv(model, path, batch_size, resume)
 
-db.drop_all()
-db.create_all()
+    print("Rebuilding indexes and foreign keys...")
+    restore_constraints(tables)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    # bulk loading skips the write paths, so build the home timelines,
+    # search index, follow suggestions and profile counters afterwards (the
+    # timelines and suggestions a batch of users at a time)
+    print("Rebuilding timelines, search, suggestions and counters...")
+    TimelineEntry.rebuild()
+    MessageSearch.rebuild()
+    FollowSuggestion.rebuild()
+    User.recount()
+    db.session.commit()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--resume', action='store_true')
+    args = parser.parse_args()
 
-db.session.commit()
+    seed(args.data_dir, args.batch_size, args.resume)
@@ -0,0 +1,32 @@
+"use strict";
+
+// Suggest usernames in the navbar search box as the user types.
+
+const TYPEAHEAD_DELAY_MS = 150;
+
+let typeaheadTimer = null;
+
+async function suggestUsers() {
+  const q = $("#search").val().trim();
+  const $suggestions = $("#search-suggestions");
+
+  if (!q) {
+    $suggestions.empty();
+    return;
+  }
+
+  const resp = await fetch(`/api/users/search?q=${encodeURIComponent(q)}`);
+  if (!resp.ok) return;
+
+  const { users } = await resp.json();
+
+  $suggestions.empty();
+  for (const user of users) {
+    $suggestions.append($("<option>").attr("value", user.username));
+  }
+}
+
+$("#search").on("input", function () {
+  clearTimeout(typeaheadTimer);
+  typeaheadTimer = setTimeout(suggestUsers, TYPEAHEAD_DELAY_MS);
+});
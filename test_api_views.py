@@ -0,0 +1,173 @@
+"""JSON API view tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python3 -m unittest test_api_views.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Follow, Like, Message, TimelineEntry, User
+from pagination import MESSAGES_PER_PAGE
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+import api
+from app import app, CURR_USER_KEY, current_user_cache
+from querystats import assert_max_queries
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RAISE_ON_LAZY_LOAD'] = True
+
+
+class APIBaseViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        current_user_cache.clear()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        db.session.add(Follow(
+            user_following_id=u1.id, user_being_followed_id=u2.id))
+
+        m1 = Message(text="m1-text", user_id=u2.id)
+        db.session.add(m1)
+        db.session.flush()
+        TimelineEntry.push(m1)
+        db.session.add(Like(user_id=u1.id, message_id=m1.id))
+        User.recount()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+
+class APIViewTestCase(APIBaseViewTestCase):
+    def test_feed(self):
+
+        # viewer, timeline page, older messages past it, liked ids
+        with assert_max_queries(4):
+            resp = self.client.get("/api/feed")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["next_cursor"], None)
+
+        [message] = resp.json["messages"]
+
+        self.assertEqual(message["text"], "m1-text")
+        self.assertEqual(message["user"]["username"], "u2")
+        self.assertTrue(message["liked"])
+
+    def test_profile(self):
+
+        resp = self.client.get(f"/api/users/{self.u2_id}")
+        user = resp.json["user"]
+
+        self.assertEqual(user["username"], "u2")
+        self.assertEqual(user["followers_count"], 1)
+        self.assertTrue(user["following"])
+        self.assertNotIn("password", user)
+        self.assertNotIn("email", user)
+
+    def test_follow_lists(self):
+
+        resp = self.client.get(f"/api/users/{self.u1_id}/following")
+
+        self.assertEqual(
+            [u["username"] for u in resp.json["users"]], ["u2"])
+
+        resp = self.client.get(f"/api/users/{self.u2_id}/followers")
+
+        self.assertEqual(
+            [u["username"] for u in resp.json["users"]], ["u1"])
+        self.assertFalse(resp.json["users"][0]["following"])
+
+    def test_pagination(self):
+
+        db.session.add_all([
+            Message(
+                text=f"more-{i}",
+                user_id=self.u2_id,
+                timestamp=datetime(2023, 1, 1) + timedelta(minutes=i))
+            for i in range(MESSAGES_PER_PAGE)
+        ])
+        db.session.commit()
+
+        seen = []
+        query = {}
+
+        while True:
+            resp = self.client.get(
+                f"/api/users/{self.u2_id}/messages", query_string=query)
+            seen += [m["text"] for m in resp.json["messages"]]
+
+            if not resp.json["next_cursor"]:
+                break
+
+            query = dict(before=resp.json["next_cursor"])
+
+        self.assertEqual(len(seen), MESSAGES_PER_PAGE + 1)
+        self.assertEqual(len(set(seen)), MESSAGES_PER_PAGE + 1)
+
+    def test_likes(self):
+
+        resp = self.client.get(f"/api/users/{self.u1_id}/likes")
+
+        self.assertEqual(
+            [m["id"] for m in resp.json["messages"]], [self.m1_id])
+
+    def test_errors_are_json(self):
+
+        resp = self.client.get("/api/users/0/followers")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn("error", resp.json)
+
+        resp = self.client.get("/api/feed?before=nonsense")
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("error", resp.json)
+
+    def test_anon(self):
+
+        resp = app.test_client().get("/api/feed")
+
+        self.assertEqual(resp.status_code, 401)
+
+    def test_stdlib_fallback(self):
+
+        data = dict(messages=[dict(id=1, timestamp=datetime(2023, 6, 1))])
+
+        with patch.object(api, 'orjson', None):
+            fallback = api.dumps(data)
+
+        self.assertEqual(
+            fallback, b'{"messages":[{"id":1,"timestamp":"2023-06-01T00:00:00"}]}')
@@ -0,0 +1,227 @@
+"""Image proxy view tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python3 -m unittest test_image_views.py
+
+
+import io
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, skipIf
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, current_user_cache
+from fragments import fragment_cache
+from images import Image, image_proxy
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def make_image(width, height):
+    """PNG bytes of a `width` x `height` image (of noise, so its resized
+    variants' sizes grow with it)."""
+
+    output = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert('RGB').save(output, 'PNG')
+    return output.getvalue()
+
+
+class Origin(ThreadingHTTPServer):
+    """Stand-in for the image hosts users link: serves `images` ({path:
+    bytes}) on localhost and counts requests per path."""
+
+    def __init__(self, images):
+        self.images = images
+        self.hits = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                self.hits[handler.path] = self.hits.get(handler.path, 0) + 1
+                body = self.images.get(handler.path)
+
+                if body is None:
+                    handler.send_error(404)
+                    return
+
+                handler.send_response(200)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+
+@skipIf(Image is None, "needs Pillow")
+class ImageProxyViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        current_user_cache.clear()
+        fragment_cache.clear()
+
+        self.origin = Origin({
+            "/header.png": make_image(2070, 1380),
+            "/avatar.png": make_image(500, 500),
+            "/small.png": make_image(50, 50),
+            "/not-an-image": b"<html></html>",
+        })
+        threading.Thread(target=self.origin.serve_forever, daemon=True).start()
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir.name
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+        image_proxy.clear()
+
+        u1 = User.signup(
+            "u1", "u1@email.com", "password", self.origin.url("/avatar.png"))
+        u1.header_image_url = self.origin.url("/header.png")
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+        self.origin.shutdown()
+        self.origin.server_close()
+        self.cache_dir.cleanup()
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+        image_proxy.clear()
+
+    def proxy_url(self, path, size):
+        with app.test_request_context():
+            return image_proxy.thumbnail_url(self.origin.url(path), size)
+
+    def test_pages_link_the_proxy(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/users").get_data(as_text=True)
+
+        self.assertIn(self.proxy_url("/header.png", "card"), html)
+        self.assertIn(self.proxy_url("/avatar.png", "avatar"), html)
+        self.assertNotIn('src="http://127.0.0.1', html)
+
+    def test_resizes_and_fetches_once(self):
+
+        url = self.proxy_url("/header.png", "card")
+        webp = self.client.get(url, headers={"Accept": "image/webp,*/*"})
+
+        self.assertEqual(webp.status_code, 200)
+        self.assertEqual(webp.mimetype, "image/webp")
+        self.assertTrue(webp.cache_control.immutable)
+        self.assertIn("Accept", webp.vary)
+        self.assertEqual(Image.open(io.BytesIO(webp.data)).size, (600, 400))
+
+        jpeg = self.client.get(url, headers={"Accept": "image/*"})
+        avatar = self.client.get(self.proxy_url("/header.png", "avatar"))
+
+        self.assertEqual(jpeg.mimetype, "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(avatar.data)).size, (200, 133))
+        self.assertEqual(self.origin.hits, {"/header.png": 1})
+
+        for resp in (webp, jpeg, avatar):
+            resp.close()
+
+        # only the sizes and formats asked for, beside the original
+        names = sorted(
+            name.split("-", 1)[1]
+            for _, _, names in os.walk(self.cache_dir.name)
+            for name in names)
+        self.assertEqual(
+            names, ["avatar.jpg", "card.jpg", "card.webp", "original.img"])
+
+    def test_rejects_unsigned_urls(self):
+
+        url = self.proxy_url("/header.png", "card")
+        resp = self.client.get(url.replace("card", "hero"))
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.origin.hits, {})
+
+    def test_unusable_images_fall_back_to_origin(self):
+
+        resp = self.client.get(self.proxy_url("/not-an-image", "card"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, self.origin.url("/not-an-image"))
+
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+        resp = self.client.get(self.proxy_url("/avatar.png", "avatar"))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertNotIn("/avatar.png", self.origin.hits)
+
+    def test_failures_are_remembered_briefly(self):
+
+        url = self.proxy_url("/not-an-image", "card")
+        app.config['IMAGE_FETCH_FAILURE_TTL'] = 0
+
+        try:
+            self.assertEqual(self.client.get(url).status_code, 302)
+            self.assertEqual(self.client.get(url).status_code, 302)
+            self.assertEqual(self.origin.hits, {"/not-an-image": 2})
+        finally:
+            app.config['IMAGE_FETCH_FAILURE_TTL'] = 60
+
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.assertEqual(self.origin.hits, {"/not-an-image": 3})
+
+    def test_cache_size_cap(self):
+
+        def cached_bytes():
+            return sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(self.cache_dir.name)
+                for name in names)
+
+        self.client.get(self.proxy_url("/avatar.png", "avatar")).close()
+        self.client.get(self.proxy_url("/header.png", "card")).close()
+
+        # just too small for one more image
+        app.config['IMAGE_CACHE_MAX_BYTES'] = cached_bytes()
+
+        try:
+            # the avatar is now the most recently used
+            self.client.get(self.proxy_url("/avatar.png", "avatar")).close()
+
+            self.client.get(self.proxy_url("/small.png", "avatar")).close()
+
+            self.assertLessEqual(
+                cached_bytes(), app.config['IMAGE_CACHE_MAX_BYTES'])
+
+            self.client.get(self.proxy_url("/avatar.png", "avatar")).close()
+            self.client.get(self.proxy_url("/header.png", "card")).close()
+        finally:
+            app.config['IMAGE_CACHE_MAX_BYTES'] = 1024 ** 3
+
+        self.assertEqual(
+            self.origin.hits,
+            {"/avatar.png": 1, "/header.png": 2, "/small.png": 1})
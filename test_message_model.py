@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follow
+from models import db, User, Message
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -58,4 +58,15 @@ class MessageModelTestCase(TestCase):
         u1 = User.query.get(self.u1_id)
 
         self.assertEqual(u1.messages, [m1])
-        self.assertEqual(m1.user_id, self.u1_id)
\ No newline at end of file
+        self.assertEqual(m1.user_id, self.u1_id)
+
+    def test_liked_ids_among(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        m2 = Message(text="unliked")
+        u2.messages.append(m2)
+        u2.likes.append(db.session.get(Message, self.m1_id))
+        db.session.commit()
+
+        self.assertEqual(
+            u2.liked_ids_among([self.m1_id, m2.id]), {self.m1_id})
+        self.assertEqual(u2.liked_ids_among([]), set())
@@ -6,9 +6,11 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User
+from models import db, Like, Message, MessageSearch, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +21,11 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, current_user_cache
+from fragments import fragment_cache
+from pagination import MESSAGES_PER_PAGE
+from querystats import assert_max_queries
+from writebehind import write_behind
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -38,10 +44,17 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail loudly if a view or template lazy-loads a relationship the view
+# didn't eager-load
+
+app.config['RAISE_ON_LAZY_LOAD'] = True
+
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
         User.query.delete()
+        current_user_cache.clear()
+        fragment_cache.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         db.session.flush()
@@ -87,7 +100,8 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            resp = c.get(f"/messages/{self.m1_id}")
+            with assert_max_queries(3):
+                resp = c.get(f"/messages/{self.m1_id}")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -109,6 +123,24 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
         self.assertEqual(u.likes, [m])
         self.assertEqual(m.liked_by, [u])
 
+    def test_like_twice_is_a_no_op(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+            resp = c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Like.query.count(), 1)
+            self.assertEqual(db.session.get(User, self.u1_id).likes_count, 1)
+
+            c.post(f"/messages/{self.m1_id}/unlike")
+            resp = c.post(f"/messages/{self.m1_id}/unlike")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(db.session.get(User, self.u1_id).likes_count, 0)
+
 class MessageDeleteViewTestCase(MessageBaseViewTestCase):
     def test_delete_message(self):
         with self.client as c:
@@ -138,4 +170,199 @@ class MessageDeleteViewTestCase(MessageBaseViewTestCase):
         self.assertEqual(resp.status_code, 302)
         self.assertEqual(resp.location, f"/users/{self.u1_id}/likes")
         self.assertEqual(u.likes, [])
-        self.assertEqual(m.liked_by, [])
\ No newline at end of file
+        self.assertEqual(m.liked_by, [])
+
+
+class MessageCounterViewTestCase(MessageBaseViewTestCase):
+    def test_counters_follow_writes(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            c.post(f"/messages/{self.m1_id}/like")
+
+            u = db.session.get(User, self.u1_id)
+            self.assertEqual(u.likes_count, 1)
+            self.assertEqual(u.messages_count, 1)
+
+            c.post(f"/messages/{self.m1_id}/delete")
+
+            u = db.session.get(User, self.u1_id)
+            self.assertEqual(u.likes_count, 0)
+            self.assertEqual(u.messages_count, 0)
+
+
+class MessageWriteBehindViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u2_id = u2.id
+
+        # flush by hand rather than from the background thread
+        app.config['WRITE_BEHIND_INTERVAL_MS'] = 60_000
+        write_behind.enabled = True
+
+    def tearDown(self):
+        write_behind.enabled = False
+        write_behind.flush()
+        super().tearDown()
+
+    def test_like_is_written_on_flush(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Like.query.count(), 0)
+
+            self.assertEqual(write_behind.flush(), 1)
+            db.session.expire_all()
+
+            u2 = db.session.get(User, self.u2_id)
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u2_id).count(), 1)
+            self.assertEqual(u2.likes_count, 1)
+
+    def test_like_unlike_pair_collapses(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+            c.post(f"/messages/{self.m1_id}/unlike")
+            c.post(f"/messages/{self.m1_id}/like")
+            c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertEqual(len(write_behind), 1)
+            write_behind.flush()
+            db.session.expire_all()
+
+            u2 = db.session.get(User, self.u2_id)
+            self.assertEqual(Like.query.count(), 1)
+            self.assertEqual(u2.likes_count, 1)
+
+    def test_follow_and_deleted_target(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+            c.post(f"/messages/{self.m1_id}/like")
+
+            # the message goes before the flush; the follow still lands
+            db.session.delete(db.session.get(Message, self.m1_id))
+            db.session.commit()
+            write_behind.flush()
+            db.session.expire_all()
+
+            u1 = db.session.get(User, self.u1_id)
+            self.assertEqual(Like.query.count(), 0)
+            self.assertEqual(u1.followers_count, 1)
+            self.assertEqual(len(write_behind), 0)
+
+    def test_final_flush_failure_is_logged(self):
+        write_behind.follow(self.u2_id, self.u1_id)
+
+        with patch.object(write_behind, '_write', side_effect=OSError):
+            with self.assertLogs('writebehind', 'ERROR') as logs:
+                self.assertEqual(write_behind.flush(requeue=False), 0)
+
+        self.assertIn("flush of 1 actions failed; dropped", logs.output[0])
+        self.assertIn("OSError", logs.output[0])
+        self.assertEqual(len(write_behind), 0)
+
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        texts = [
+            (self.u1_id, "Birds sing at dawn", datetime(2023, 1, 1)),
+            (self.u1_id, "birds birds birds", datetime(2023, 2, 1)),
+            (u2.id, "A bird in the hand", datetime(2023, 3, 1)),
+            (u2.id, "Nothing to see here", datetime(2023, 4, 1)),
+        ]
+        self.ids = {}
+
+        for user_id, text, timestamp in texts:
+            msg = Message(text=text, user_id=user_id, timestamp=timestamp)
+            db.session.add(msg)
+            db.session.flush()
+            MessageSearch.add(msg)
+            self.ids[text] = msg.id
+
+        db.session.commit()
+        self.u2_id = u2.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def search(self, **args):
+        resp = self.client.get("/api/messages/search", query_string=args)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json
+
+    def found(self, **args):
+        return [m["text"] for m in self.search(**args)["messages"]]
+
+    def test_search_page(self):
+
+        with assert_max_queries(6):
+            resp = self.client.get("/messages/search?q=birds")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("test message search route", html)
+        self.assertIn("birds birds birds", html)
+        self.assertIn("Birds sing at dawn", html)
+        self.assertNotIn("Nothing to see here", html)
+        self.assertLess(html.index("birds birds birds"),
+                        html.index("Birds sing at dawn"))
+
+    def test_filters(self):
+
+        self.assertEqual(self.found(q="birds", author="U1", until="2023-01-01"),
+                         ["Birds sing at dawn"])
+        self.assertEqual(
+            self.found(q="birds", author="u1", since="2023-01-02"),
+            ["birds birds birds"])
+        self.assertEqual(self.found(q="birds", author="nobody"), [])
+        self.assertEqual(self.found(q='"; DROP TABLE messages'), [])
+
+        resp = self.client.get("/api/messages/search?q=birds&since=yesterday")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_pagination(self):
+
+        for i in range(MESSAGES_PER_PAGE):
+            msg = Message(text=f"dawn chorus {i}", user_id=self.u2_id)
+            db.session.add(msg)
+            db.session.flush()
+            MessageSearch.add(msg)
+
+        db.session.commit()
+
+        first = self.search(q="dawn")
+        second = self.search(q="dawn", after=first["next_cursor"])
+        seen = [m["id"] for m in first["messages"] + second["messages"]]
+
+        self.assertEqual(len(first["messages"]), MESSAGES_PER_PAGE)
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(len(set(seen)), MESSAGES_PER_PAGE + 1)
+
+    def test_deleted_messages_leave_the_index(self):
+
+        self.client.post(f"/messages/{self.ids['birds birds birds']}/delete")
+        User.query.filter_by(id=self.u2_id).delete()
+        db.session.commit()
+
+        self.assertEqual(self.found(q="hand"), [])
+        self.assertEqual(self.found(q="birds"), ["Birds sing at dawn"])
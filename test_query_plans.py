@@ -0,0 +1,204 @@
+"""Query plan and migration tests.
+
+Seeds a hundred thousand or so rows, then EXPLAINs every SELECT the hot
+pages run and fails if one reads a big table in full: the sign of a
+missing (or unusable) index, which small test data would never show as
+slowness.
+"""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python3 -m unittest test_query_plans.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+
+from models import (
+    db, include_in_migrations, Follow, FollowSuggestion, Like, Message,
+    MessageSearch, TimelineEntry, User, DEFAULT_HEADER_IMAGE_URL,
+    DEFAULT_IMAGE_URL)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, current_user_cache
+from fragments import fragment_cache
+from querystats import assert_no_table_scans
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Enough users, with rows as wide as real ones, that PostgreSQL's planner
+# prices reading `users` in full above probing it by primary key, as it
+# does in production; with fewer it rightly scans the handful of pages.
+USERS = 5000
+MESSAGES_PER_USER = 20
+FOLLOWS_PER_USER = 20
+LIKES_PER_USER = 20
+
+# tables big enough that reading one in full is a bug (a join that walks
+# every user and probes follows or likes by primary key shows up as a scan
+# of users)
+HOT_TABLES = [
+    'users', 'messages', 'follows', 'likes', 'timeline_entries',
+    'follow_suggestions']
+
+
+def seed():
+    """Load USERS users with messages, follows and likes, in bulk."""
+
+    start = datetime(2023, 1, 1)
+
+    db.session.execute(db.insert(User), [
+        dict(id=i, username=f"user{i}", email=f"user{i}@email.com",
+             password="x", image_url=DEFAULT_IMAGE_URL,
+             header_image_url=DEFAULT_HEADER_IMAGE_URL,
+             bio=f"bio of user {i}", location="")
+        for i in range(1, USERS + 1)
+    ])
+    db.session.execute(db.insert(Message), [
+        dict(id=(user - 1) * MESSAGES_PER_USER + n + 1,
+             user_id=user,
+             text=f"message {n} of {user}",
+             timestamp=start + timedelta(minutes=n * USERS + user))
+        for user in range(1, USERS + 1)
+        for n in range(MESSAGES_PER_USER)
+    ])
+    db.session.execute(db.insert(Follow), [
+        dict(user_following_id=user,
+             user_being_followed_id=(user + n) % USERS + 1)
+        for user in range(1, USERS + 1)
+        for n in range(FOLLOWS_PER_USER)
+    ])
+    db.session.execute(db.insert(Like), [
+        dict(user_id=user,
+             message_id=(user * 7 + n * 31) % (USERS * MESSAGES_PER_USER) + 1)
+        for user in range(1, USERS + 1)
+        for n in range(LIKES_PER_USER)
+    ])
+
+    TimelineEntry.rebuild()
+    MessageSearch.rebuild()
+    FollowSuggestion.rebuild()
+    User.recount()
+    db.session.commit()
+
+    # give the planner real statistics, as production has
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("ANALYZE")
+
+
+class QueryPlanTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        User.query.delete()
+        db.session.commit()
+        seed()
+
+    @classmethod
+    def tearDownClass(cls):
+        User.query.delete()
+        db.session.commit()
+
+    def setUp(self):
+        current_user_cache.clear()
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assert_pages_use_indexes(self, *urls):
+        for url in urls:
+            with self.subTest(url=url):
+                with assert_no_table_scans(db.engine, HOT_TABLES):
+                    resp = self.client.get(url)
+
+                self.assertEqual(resp.status_code, 200)
+
+    def test_feed(self):
+
+        # the second cursor is older than the whole timeline, so the feed
+        # falls back to reading followed users' messages directly
+        self.assert_pages_use_indexes(
+            "/",
+            "/api/feed",
+            "/api/feed?before=2023-01-01T00:00:00_1")
+
+    def test_profiles(self):
+
+        self.assert_pages_use_indexes(
+            "/users/2",
+            "/api/users/2/messages",
+            "/users/2/following",
+            "/users/2/followers",
+            "/api/users/2/following",
+            "/api/users/2/followers")
+
+    def test_likes(self):
+
+        self.assert_pages_use_indexes(
+            "/users/2/likes",
+            "/api/users/2/likes",
+            "/messages/2")
+
+    def test_search(self):
+
+        self.assert_pages_use_indexes(
+            "/messages/search?q=message+7",
+            "/api/messages/search?q=message&author=user2",
+            "/api/messages/search?q=message&since=2023-01-02&until=2023-01-03")
+
+    def test_suggestions(self):
+
+        self.assert_pages_use_indexes("/api/users/suggestions")
+
+    def test_liked_by(self):
+
+        message = db.session.get(Message, 2)
+
+        with assert_no_table_scans(db.engine, HOT_TABLES):
+            message.liked_by
+
+
+class MigrationTestCase(TestCase):
+    def test_migrations_match_models(self):
+
+        with tempfile.TemporaryDirectory() as scratch:
+            engine = db.create_engine(f"sqlite:///{scratch}/migrated.db")
+            config = Config("migrations/alembic.ini")
+            config.set_main_option("script_location", "migrations")
+
+            with engine.begin() as connection:
+                config.attributes['connection'] = connection
+                command.upgrade(config, "head")
+
+                context = MigrationContext.configure(
+                    connection, opts=dict(include_name=include_in_migrations))
+                diff = compare_metadata(context, db.metadata)
+
+            engine.dispose()
+
+        self.assertEqual(diff, [])
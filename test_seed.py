@@ -0,0 +1,84 @@
+"""Seed loader tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python3 -m unittest test_seed.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, Follow, Like, Message, TimelineEntry, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import seed
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+def write_csv(folder, name, header, rows):
+    with open(os.path.join(folder, name), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+class SeedTestCase(TestCase):
+    def tearDown(self):
+        db.session.rollback()
+
+        # leave the schema the other test modules expect
+        db.drop_all()
+        db.create_all()
+
+    def test_seed_loads_csvs_and_derived_data(self):
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_csv(data_dir, 'users.csv', [
+                'email', 'username', 'image_url', 'password', 'bio',
+                'header_image_url', 'location',
+            ], [
+                [f"u{i}@email.com", f"u{i}", "", "x", "", "", ""]
+                for i in range(1, 4)
+            ])
+            write_csv(data_dir, 'messages.csv', [
+                'text', 'timestamp', 'user_id',
+            ], [
+                ["hello", "2023-01-01 00:00:00", 1],
+                ["again", "2023-01-02 00:00:00", 1],
+                ["hi", "2023-01-03 00:00:00", 2],
+            ])
+            write_csv(data_dir, 'follows.csv', [
+                'user_being_followed_id', 'user_following_id',
+            ], [[1, 2], [1, 3], [2, 3]])
+            write_csv(data_dir, 'likes.csv', [
+                'user_id', 'message_id',
+            ], [[3, 1]])
+
+            # batches smaller than the files, so loads span commits
+            seed.seed(data_dir, batch_size=2)
+
+        db.session.expire_all()
+        u1, u2, u3 = [db.session.get(User, i) for i in range(1, 4)]
+
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follow.query.count(), 3)
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(
+            (u1.messages_count, u1.followers_count, u1.following_count),
+            (2, 2, 0))
+        self.assertEqual((u3.following_count, u3.likes_count), (2, 1))
+        self.assertEqual(
+            TimelineEntry.query.filter_by(owner_id=u3.id).count(), 3)
+        self.assertEqual(u2.messages_count, 1)
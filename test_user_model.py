@@ -6,10 +6,13 @@
 
 
 import os
+import threading
 from unittest import TestCase
 
-from models import db, User, Message, Follow
+from models import (
+    db, User, Message, Follow, FollowSuggestion, SUGGESTIONS_KEPT)
 from flask_bcrypt import Bcrypt
+from hashing import password_hasher, HashingBusy
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -74,4 +77,173 @@ class UserModelTestCase(TestCase):
         u1 = db.session.get(User,self.u1_id)
         self.assertFalse(User.authenticate("u1", "wrong"))
 
-    
\ No newline at end of file
+    
+    def test_recount(self):
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+
+        u1.following.append(u2)
+        u1.messages.append(Message(text="hello"))
+        db.session.commit()
+
+        User.recount()
+        db.session.commit()
+
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.followers_count, 0)
+        self.assertEqual(u2.followers_count, 1)
+
+    def test_adjust_counts(self):
+        User.adjust_counts([self.u1_id, self.u2_id], likes_count=2)
+        User.adjust_counts(self.u1_id, likes_count=-1)
+        db.session.commit()
+
+        self.assertEqual(db.session.get(User, self.u1_id).likes_count, 1)
+        self.assertEqual(db.session.get(User, self.u2_id).likes_count, 2)
+
+    def test_is_following(self):
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u2.is_following(u1))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertFalse(u1.is_followed_by(u2))
+
+    def test_following_ids_among(self):
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(
+            u1.following_ids_among([self.u1_id, self.u2_id]), {self.u2_id})
+        self.assertEqual(u2.following_ids_among([self.u1_id]), set())
+
+    def test_follow_add_remove_are_idempotent(self):
+        self.assertTrue(Follow.add(self.u1_id, self.u2_id))
+        self.assertFalse(Follow.add(self.u1_id, self.u2_id))
+        db.session.commit()
+
+        u1 = db.session.get(User, self.u1_id)
+        u2 = db.session.get(User, self.u2_id)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+
+        self.assertTrue(Follow.remove(self.u1_id, self.u2_id))
+        self.assertFalse(Follow.remove(self.u1_id, self.u2_id))
+        db.session.commit()
+
+        self.assertFalse(Follow.exists(self.u1_id, self.u2_id))
+        self.assertEqual(db.session.get(User, self.u1_id).following_count, 0)
+
+    def test_follow_suggestions_track_follows(self):
+        u3, u4, u5, u6 = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(3, 7)]
+        db.session.flush()
+        u1, u2 = self.u1_id, self.u2_id
+
+        def suggestions(user_id):
+            return {
+                s.suggested_id: s.mutuals
+                for s in FollowSuggestion.query.filter_by(user_id=user_id)}
+
+        def assert_matches_rebuild(user_id):
+            incremental = suggestions(user_id)
+            FollowSuggestion.rebuild()
+            self.assertEqual(incremental, suggestions(user_id))
+
+        # u2 -> u4, u5; u3 -> u4; u6 -> u1
+        for follower, followed in [
+                (u2, u4.id), (u2, u5.id), (u3.id, u4.id), (u6.id, u1)]:
+            Follow.add(follower, followed)
+
+        Follow.add(u1, u2)
+        Follow.add(u1, u3.id)
+        self.assertEqual(
+            FollowSuggestion.top(User.query, u1, 5),
+            [(u4, 2), (u5, 1)])
+
+        # only the follower's own suggestions move; u6's wait for a rebuild
+        self.assertEqual(suggestions(u6.id), {})
+        assert_matches_rebuild(u1)
+        self.assertEqual(suggestions(u6.id), {u2: 1, u3.id: 1})
+
+        Follow.add(u1, u4.id)
+        self.assertNotIn(u4.id, suggestions(u1))
+        assert_matches_rebuild(u1)
+
+        Follow.remove(u1, u2)
+        self.assertEqual(suggestions(u1), {})
+        assert_matches_rebuild(u1)
+
+    def test_bounded_follow_suggestions_match_rebuild(self):
+        # u3 follows more users than a follow of u3 scores; u2 follows the
+        # first of them
+        others = [
+            User(username=f"o{i}", email=f"o{i}@email.com", password="x")
+            for i in range(SUGGESTIONS_KEPT + 5)]
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.add_all(others)
+        db.session.flush()
+        u1, u2 = self.u1_id, self.u2_id
+
+        for other in others:
+            Follow.add(u3.id, other.id)
+
+        Follow.add(u2, others[0].id)
+        Follow.add(u1, u2)
+
+        def assert_matches_rebuild():
+            incremental = FollowSuggestion.query.filter_by(user_id=u1).all()
+            incremental = {s.suggested_id: s.mutuals for s in incremental}
+            FollowSuggestion.rebuild()
+            self.assertEqual(incremental, {
+                s.suggested_id: s.mutuals
+                for s in FollowSuggestion.query.filter_by(user_id=u1)})
+
+            return incremental
+
+        scores = assert_matches_rebuild()
+        self.assertEqual(scores, {others[0].id: 1})
+
+        Follow.add(u1, u3.id)
+        scores = assert_matches_rebuild()
+        self.assertEqual(len(scores), SUGGESTIONS_KEPT)
+        self.assertEqual(scores[others[0].id], 2)
+
+        Follow.remove(u1, u3.id)
+        self.assertEqual(assert_matches_rebuild(), {others[0].id: 1})
+
+    def test_auth_rehashes_outdated_cost(self):
+        u1 = db.session.get(User, self.u1_id)
+        u1.password = bcrypt.generate_password_hash(
+            "password", rounds=4).decode('UTF-8')
+        db.session.commit()
+
+        self.assertEqual(User.authenticate("u1", "password"), u1)
+        db.session.commit()
+
+        u1 = db.session.get(User, self.u1_id)
+        self.assertFalse(u1.password.startswith("$2b$04$"))
+        self.assertTrue(bcrypt.check_password_hash(u1.password, "password"))
+
+    def test_hashing_busy(self):
+        slots = password_hasher._slots
+        password_hasher._slots = threading.BoundedSemaphore(1)
+
+        try:
+            password_hasher._slots.acquire()
+            with self.assertRaises(HashingBusy):
+                User.authenticate("u1", "password")
+        finally:
+            password_hasher._slots = slots
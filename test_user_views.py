@@ -5,10 +5,19 @@
 #    FLASK_DEBUG=False python3 -m unittest test_message_views.py
 
 
+import gzip
 import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, Message, User
+from models import (
+    db, DeletionJob, Follow, FollowSuggestion, Message, User, Like,
+    TimelineEntry, TIMELINE_LENGTH)
+from hashing import password_hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +28,13 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+import build_assets
+from app import app, CURR_USER_KEY, current_user_cache
+from assets import assets
+from deletion import deletion_worker
+from fragments import fragment_cache
+from querystats import assert_max_queries
+from replicas import replica_router
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -38,16 +53,29 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail loudly if a view or template lazy-loads a relationship the view
+# didn't eager-load
+
+app.config['RAISE_ON_LAZY_LOAD'] = True
+
+# Run account deletions only when a test asks
+
+app.config['DELETION_IN_BACKGROUND'] = False
+
 
 class UserBaseViewTestCase(TestCase):
     def setUp(self):
         User.query.delete()
+        current_user_cache.clear()
+        fragment_cache.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         db.session.flush()
 
         m1 = Message(text="m1-text", user_id=u1.id)
         db.session.add_all([m1])
+        db.session.flush()
+        TimelineEntry.push(m1)
         db.session.commit()
 
         self.u1_id = u1.id
@@ -67,7 +95,8 @@ class UserAddViewTestCase(UserBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            resp = c.get("/")
+            with assert_max_queries(5):
+                resp = c.get("/")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -80,7 +109,8 @@ class UserAddViewTestCase(UserBaseViewTestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.u1_id
 
-            resp = c.get("/users")
+            with assert_max_queries(3):
+                resp = c.get("/users")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -96,7 +126,8 @@ class UserAddViewTestCase(UserBaseViewTestCase):
             u2 = User.signup("u2", "u2@email.com", "password", None)
             db.session.commit()
 
-            resp = c.get(f"/users/{u2.id}")
+            with assert_max_queries(4):
+                resp = c.get(f"/users/{u2.id}")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -114,9 +145,691 @@ class UserAddViewTestCase(UserBaseViewTestCase):
             u1.following.append(u2)
             db.session.commit()
 
-            resp = c.get(f"/users/{self.u1_id}/following")
+            with assert_max_queries(3):
+                resp = c.get(f"/users/{self.u1_id}/following")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("u2", html)
             self.assertIn("test user following route", html)
+
+    def test_show_liked_messages(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            u2 = User.signup("u2", "u2@email.com", "password", None)
+            db.session.flush()
+            m2 = Message(text="m2-text", user_id=u2.id)
+            db.session.add(m2)
+            db.session.flush()
+            db.session.add(Like(user_id=self.u1_id, message_id=m2.id))
+            db.session.commit()
+
+            with assert_max_queries(4):
+                resp = c.get(f"/users/{self.u1_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m2-text", html)
+            self.assertIn("@u2", html)
+            self.assertIn(f"/messages/{m2.id}/unlike", html)
+
+class UserTimelineViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add(m2)
+        db.session.flush()
+        TimelineEntry.push(m2)
+        db.session.commit()
+
+        self.u2_id = u2.id
+
+    def test_follow_backfills_timeline(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("m2-text", html)
+
+            c.post(f"/users/follow/{self.u2_id}")
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertIn("m2-text", html)
+
+    def test_unfollow_purges_timeline(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            c.post(f"/users/stop-following/{self.u2_id}")
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertNotIn("m2-text", html)
+
+    def test_new_message_fans_out_to_followers(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "fresh-warble"})
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(owner_id=self.u2_id).count(),
+                3)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("fresh-warble", html)
+
+class UserPaginationViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        for i in range(TIMELINE_LENGTH + 5):
+            m = Message(
+                text=f"warble-{i}-",
+                user_id=self.u1_id,
+                timestamp=datetime(2023, 1, 1) + timedelta(minutes=i))
+            db.session.add(m)
+            db.session.flush()
+            TimelineEntry.push(m)
+
+        db.session.commit()
+
+    def _collect_pages(self, c, url):
+        """Follow 'Older' links from `url`; return the warble texts seen."""
+
+        seen = []
+
+        while url:
+            html = c.get(url).get_data(as_text=True)
+            seen.extend(re.findall(r"warble-\d+-", html))
+            found = re.search(r'href="([^"]*before=[^"]*)"', html)
+            url = found and found.group(1).replace("&amp;", "&")
+
+        return seen
+
+    def test_feed_pages_past_timeline(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = self._collect_pages(c, "/")
+
+            self.assertEqual(len(seen), TIMELINE_LENGTH + 5)
+            self.assertEqual(len(set(seen)), TIMELINE_LENGTH + 5)
+            self.assertEqual(seen[0], f"warble-{TIMELINE_LENGTH + 4}-")
+            self.assertEqual(seen[-1], "warble-0-")
+
+    def test_profile_pages(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = self._collect_pages(c, f"/users/{self.u1_id}")
+
+            self.assertEqual(len(set(seen)), TIMELINE_LENGTH + 5)
+
+    def test_bad_cursor(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/?before=nonsense")
+
+            self.assertEqual(resp.status_code, 400)
+
+class UserSearchViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        for username in ["alice", "Alicia", "malice", "al_x"]:
+            User.signup(username, f"{username}@email.com", "password", None)
+
+        db.session.commit()
+
+    def test_search_by_prefix(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users?q=ali")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@alice", html)
+            self.assertIn("@Alicia", html)
+            self.assertNotIn("@malice", html)
+
+    def test_search_json(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/api/users/search?q=AL")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                sorted(u["username"] for u in resp.json["users"]),
+                ["Alicia", "al_x", "alice"])
+
+            resp = c.get("/api/users/search?q=alic")
+
+            self.assertEqual(resp.json["users"][0]["username"], "alice")
+
+    def test_search_json_anon(self):
+
+        resp = self.client.get("/api/users/search?q=al")
+
+        self.assertEqual(resp.status_code, 401)
+
+class UserCacheViewTestCase(UserBaseViewTestCase):
+    def test_profile_edit_refreshes_current_user(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("@u1", c.get("/").get_data(as_text=True))
+
+            c.post("/users/profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("@u1-renamed", html)
+
+    def test_cached_user_skips_database(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/messages/new")
+
+            # change the row behind the app's back; the cached copy wins
+            db.session.execute(
+                db.update(User)
+                .where(User.id == self.u1_id)
+                .values(username="changed"))
+            db.session.commit()
+            db.session.expunge_all()
+
+            html = c.get("/messages/new").get_data(as_text=True)
+
+            self.assertIn('alt="u1"', html)
+
+            current_user_cache.clear()
+            db.session.expunge_all()
+            html = c.get("/messages/new").get_data(as_text=True)
+
+            self.assertIn('alt="changed"', html)
+
+class UserFragmentCacheViewTestCase(UserBaseViewTestCase):
+    def test_message_items_are_reused_across_viewers(self):
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            cached = len(fragment_cache)
+
+            # the author sees no like button on their own message
+            self.assertNotIn(f"/messages/{self.m1_id}/like", html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+
+            self.assertEqual(len(fragment_cache), cached)
+            self.assertIn("m1-text", html)
+            self.assertIn(f"/messages/{self.m1_id}/like", html)
+
+    def test_profile_change_rerenders_card(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("@u1<", c.get("/users").get_data(as_text=True))
+
+            c.post("/users/profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+            html = c.get("/users").get_data(as_text=True)
+
+            self.assertIn("@u1-renamed", html)
+            self.assertNotIn("@u1<", html)
+
+class UserLoginViewTestCase(UserBaseViewTestCase):
+    def test_login(self):
+
+        resp = self.client.post(
+            "/login", data={"username": "u1", "password": "password"})
+
+        self.assertEqual(resp.status_code, 302)
+
+    def test_login_when_hashing_saturated(self):
+        slots = password_hasher._slots
+        password_hasher._slots = threading.BoundedSemaphore(1)
+
+        try:
+            password_hasher._slots.acquire()
+            resp = self.client.post(
+                "/login", data={"username": "u1", "password": "password"})
+        finally:
+            password_hasher._slots = slots
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("Retry-After", resp.headers)
+
+class UserQueryStatsViewTestCase(UserBaseViewTestCase):
+    def test_query_stats_headers(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users")
+
+            self.assertGreater(int(resp.headers["X-DB-Query-Count"]), 0)
+            self.assertIn("X-DB-Time-Ms", resp.headers)
+            self.assertNotIn("X-DB-Repeated-Queries", resp.headers)
+
+    def test_assert_max_queries(self):
+
+        with self.assertRaises(AssertionError):
+            with assert_max_queries(1):
+                User.query.all()
+                User.query.all()
+
+class UserConditionalGetViewTestCase(UserBaseViewTestCase):
+    def test_unchanged_profile_is_not_modified(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            etag = resp.headers["ETag"]
+
+            self.assertIn("private", resp.headers["Cache-Control"])
+            self.assertIn("Last-Modified", resp.headers)
+
+            with assert_max_queries(1):
+                resp = c.get(f"/users/{self.u1_id}",
+                             headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+    def test_new_message_changes_etag(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            etag = c.get("/").headers["ETag"]
+            c.post("/messages/new", data={"text": "m2-text"})
+
+            resp = c.get("/", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m2-text", resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_static_files_are_cacheable(self):
+
+        resp = self.client.get("/static/stylesheets/style.css")
+        resp.close()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(resp.cache_control.max_age, 0)
+        self.assertFalse(resp.cache_control.no_store)
+
+class UserReplicaViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.replica_dir = tempfile.TemporaryDirectory()
+        replica_router.configure(
+            [f"sqlite:///{self.replica_dir.name}/replica.db"])
+        replica = replica_router.engines[0]
+        db.metadata.create_all(replica)
+
+        # the replica has u1, plus a user the primary doesn't
+        u1 = db.session.get(User, self.u1_id)
+
+        with replica.begin() as conn:
+            conn.execute(db.insert(User.__table__), u1.column_values())
+            conn.execute(db.insert(User.__table__), dict(
+                username="replica-only", email="r@email.com", password="x"))
+
+    def tearDown(self):
+        super().tearDown()
+        replica_router.configure([])
+        self.replica_dir.cleanup()
+
+    def test_reads_go_to_replica(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/users").get_data(as_text=True)
+
+            self.assertIn("@replica-only", html)
+
+    def test_reads_after_write_stay_on_primary(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "m2-text"})
+            html = c.get("/users").get_data(as_text=True)
+
+            self.assertNotIn("@replica-only", html)
+            self.assertEqual(
+                Message.query.filter_by(text="m2-text").count(), 1)
+
+
+class UserDeletionViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+        DeletionJob.query.delete()
+
+        # u2 follows u1 and likes m1; u1 likes m2
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add(m2)
+        db.session.flush()
+
+        Follow.add(u2.id, self.u1_id)
+        Like.add(u2.id, self.m1_id)
+        Like.add(self.u1_id, m2.id)
+        db.session.commit()
+
+        self.u2_id = u2.id
+
+    def delete_u1(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/delete")
+
+        self.assertEqual(resp.status_code, 302)
+
+    def test_deleted_user_is_hidden_at_once(self):
+
+        self.delete_u1()
+
+        self.assertEqual(DeletionJob.query.one().stage, "timelines")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            self.assertNotIn("@u1", c.get("/users").get_data(as_text=True))
+            self.assertEqual(c.get(f"/users/{self.u1_id}").status_code, 404)
+            self.assertEqual(c.get(f"/messages/{self.m1_id}").status_code, 404)
+
+        self.assertFalse(User.authenticate("u1", "password"))
+
+    def test_deleted_user_is_hidden_from_the_api(self):
+
+        Follow.add(self.u1_id, self.u2_id)
+        db.session.commit()
+        self.delete_u1()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for url in ("/api/feed",
+                        f"/api/users/{self.u2_id}/likes",
+                        "/api/messages/search?q=m1"):
+                with self.subTest(url=url):
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertNotIn(
+                        self.m1_id, [m["id"] for m in resp.json["messages"]])
+
+            for url in (f"/api/users/{self.u2_id}/following",
+                        f"/api/users/{self.u2_id}/followers"):
+                with self.subTest(url=url):
+                    self.assertEqual(c.get(url).json["users"], [])
+
+            for url in (f"/api/users/{self.u1_id}",
+                        f"/api/users/{self.u1_id}/messages",
+                        f"/api/users/{self.u1_id}/likes",
+                        f"/api/users/{self.u1_id}/following",
+                        f"/api/users/{self.u1_id}/followers"):
+                with self.subTest(url=url):
+                    self.assertEqual(c.get(url).status_code, 404)
+
+    def test_purge(self):
+
+        self.delete_u1()
+        self.assertEqual(deletion_worker.run_pending(), 1)
+
+        db.session.expire_all()
+        u2 = db.session.get(User, self.u2_id)
+
+        self.assertEqual(u2.following_count, 0)
+        self.assertEqual(u2.likes_count, 0)
+        self.assertEqual(
+            db.session.execute(
+                db.select(User.id).where(User.id == self.u1_id)
+                .execution_options(include_deleted=True)).all(),
+            [])
+        self.assertEqual(Message.query.filter_by(id=self.m1_id).count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(DeletionJob.query.one().stage, DeletionJob.DONE)
+        self.assertEqual(deletion_worker.run_pending(), 0)
+
+    def test_purge_resumes_batch_by_batch(self):
+
+        self.delete_u1()
+        job = DeletionJob.query.one()
+        stages = []
+
+        while job.stage != DeletionJob.DONE:
+            stages.append(job.stage)
+            job.run_batch(1)
+            db.session.commit()
+
+            # as if the worker restarted between batches
+            db.session.expire_all()
+            job = DeletionJob.query.one()
+
+        self.assertEqual(
+            stages.count("likes"), 3, "two likes, then an empty batch")
+        # timeline entries, likes, the follow, m1, u1
+        self.assertEqual(job.rows_deleted, 2 + 2 + 1 + 1 + 1)
+        self.assertEqual(db.session.get(User, self.u2_id).followers_count, 0)
+
+
+class UserAssetViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        app.config['ASSET_DIR'] = 'test-dist'
+        self.manifest = build_assets.build(app.static_folder, 'test-dist')
+        assets.load()
+
+    def tearDown(self):
+        super().tearDown()
+
+        shutil.rmtree(os.path.join(app.static_folder, 'test-dist'))
+        app.config['ASSET_DIR'] = 'dist'
+        assets.load()
+
+    def test_pages_link_hashed_assets(self):
+
+        css = self.manifest["files"]["stylesheets/style.css"]
+        html = self.client.get("/login").get_data(as_text=True)
+
+        self.assertIn(f"/static/{css}", html)
+        self.assertNotIn("/static/stylesheets/style.css", html)
+
+        resp = self.client.get(f"/static/{css}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.cache_control.immutable)
+        self.assertEqual(
+            resp.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertIn(
+            self.manifest["files"]["images/nav-bg.png"],
+            resp.get_data(as_text=True))
+        resp.close()
+
+    def test_precompressed_variants(self):
+
+        css = f'/static/{self.manifest["files"]["stylesheets/style.css"]}'
+        plain = self.client.get(css)
+
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn("Accept-Encoding", plain.vary)
+
+        zipped = self.client.get(
+            css, headers={"Accept-Encoding": "gzip, deflate"})
+
+        self.assertEqual(zipped.content_encoding, "gzip")
+        self.assertEqual(zipped.mimetype, "text/css")
+        self.assertEqual(gzip.decompress(zipped.data), plain.data)
+
+        if build_assets.brotli is not None:
+            resp = self.client.get(
+                css, headers={"Accept-Encoding": "gzip, br"})
+
+            self.assertEqual(resp.content_encoding, "br")
+            self.assertEqual(
+                build_assets.brotli.decompress(resp.data), plain.data)
+
+        # already-compressed images are served as they are
+        image = self.manifest["files"]["images/warbler-hero.jpg"]
+        resp = self.client.get(
+            f"/static/{image}", headers={"Accept-Encoding": "gzip, br"})
+
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(self.manifest["encodings"][image], [])
+
+        for resp in (plain, zipped, resp):
+            resp.close()
+
+    def test_new_build_changes_page_etag(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            etag = c.get("/").headers["ETag"]
+            assets.version = "next-build"
+
+            self.assertNotEqual(c.get("/").headers["ETag"], etag)
+
+
+class UserSuggestionViewTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # u2 and u3 both follow u4; u3 follows u5
+        u2, u3, u4, u5 = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(2, 6)]
+        db.session.flush()
+
+        Follow.add(u2.id, u4.id)
+        Follow.add(u3.id, u4.id)
+        Follow.add(u3.id, u5.id)
+        db.session.commit()
+
+        self.u2_id, self.u3_id, self.u4_id, self.u5_id = (
+            u2.id, u3.id, u4.id, u5.id)
+
+    def suggested(self, c):
+        return [(u["username"], u["mutuals"])
+                for u in c.get("/api/users/suggestions").json["users"]]
+
+    def test_suggestions_follow_follows(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertEqual(self.suggested(c), [])
+            self.assertNotIn("Who to follow", c.get("/").get_data(as_text=True))
+
+            c.post(f"/users/follow/{self.u2_id}")
+            c.post(f"/users/follow/{self.u3_id}")
+
+            self.assertEqual(self.suggested(c), [("u4", 2), ("u5", 1)])
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("Followed by 2 you follow", html)
+
+            c.post(f"/users/follow/{self.u4_id}")
+
+            self.assertEqual(self.suggested(c), [("u5", 1)])
+
+    def test_followed_users_following_changes_etag(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            etag = c.get("/").headers["ETag"]
+
+            # only u2's follows (and, once rebuilt, u1's suggestions)
+            # change, not the viewer's row
+            Follow.add(self.u2_id, self.u5_id)
+            FollowSuggestion.rebuild()
+            db.session.commit()
+
+            resp = c.get("/", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u5", resp.get_data(as_text=True))
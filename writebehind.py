@@ -0,0 +1,207 @@
+"""Write-behind batching for likes and follows.
+
+With WRITE_BEHIND on, like/unlike and follow/unfollow clicks don't write
+to the database in the request. They're queued in process, and a
+background thread flushes the queue every WRITE_BEHIND_INTERVAL_MS (or
+sooner, once WRITE_BEHIND_MAX_BATCH actions are waiting) in a single
+transaction: one multi-row INSERT ... ON CONFLICT DO NOTHING and one bulk
+DELETE per table, plus the counter and timeline updates for the rows that
+actually changed.
+
+Actions are coalesced per (user, target): only the last one counts, so a
+like followed by an unlike before the flush writes nothing at all. The
+queue is flushed once more at interpreter exit, and a failed flush puts
+its actions back (behind any newer ones) to retry on the next round;
+that last flush has no next round, so if it fails its actions are logged
+as lost.
+
+The trade-off is that a click shows up a flush interval late, including
+on the page the click redirects to.
+"""
+
+import atexit
+import logging
+import threading
+
+from models import db, Follow, Like, Message, User
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL_MS = 50
+DEFAULT_MAX_BATCH = 1000
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+# action kind -> model that records it
+MODELS = {LIKE: Like, FOLLOW: Follow}
+
+
+class WriteBehindQueue:
+    """Pending like/follow actions and the thread that flushes them.
+
+    Configured from the app's WRITE_BEHIND (on/off), WRITE_BEHIND_INTERVAL_MS
+    and WRITE_BEHIND_MAX_BATCH. `on_flush` is called with the ids of users
+    whose rows a flush changed, e.g. to drop them from caches.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.on_flush = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def init_app(self, app, on_flush=None):
+        """Read write-behind settings from `app.config`."""
+
+        self.app = app
+        self.on_flush = on_flush
+        self.enabled = app.config.setdefault('WRITE_BEHIND', False)
+        app.config.setdefault('WRITE_BEHIND_INTERVAL_MS', DEFAULT_INTERVAL_MS)
+        app.config.setdefault('WRITE_BEHIND_MAX_BATCH', DEFAULT_MAX_BATCH)
+
+    def like(self, user_id, message_id, liked=True):
+        """Queue `user_id` liking (or unliking) `message_id`."""
+
+        self._enqueue((LIKE, user_id, message_id), liked)
+
+    def follow(self, follower_id, followed_id, following=True):
+        """Queue `follower_id` following (or unfollowing) `followed_id`."""
+
+        self._enqueue((FOLLOW, follower_id, followed_id), following)
+
+    def _enqueue(self, key, present):
+        with self._lock:
+            # only the last action on a (kind, user, target) matters
+            self._pending.pop(key, None)
+            self._pending[key] = present
+            backlog = len(self._pending)
+
+        self._start()
+
+        if backlog >= self.app.config['WRITE_BEHIND_MAX_BATCH']:
+            self._wake.set()
+
+    def _start(self):
+        """Start the flusher thread on first use (so not in a parent process
+        that forks its workers)."""
+
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self):
+        interval = self.app.config['WRITE_BEHIND_INTERVAL_MS'] / 1000
+
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        """Stop the flusher thread and flush whatever is left."""
+
+        self._stop.set()
+        self._wake.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        # nothing flushes after this, so there's no point requeueing
+        self.flush(requeue=False)
+
+    def flush(self, requeue=True):
+        """Write all pending actions in one transaction.
+
+        Returns the number of actions flushed. On failure they're queued
+        again, unless a newer action on the same key arrived meanwhile, or
+        `requeue` is false, when they're dropped.
+        """
+
+        with self._lock:
+            batch, self._pending = self._pending, {}
+
+        if not batch:
+            return 0
+
+        try:
+            with self.app.app_context():
+                changed_user_ids = self._write(batch)
+                db.session.commit()
+        except Exception:
+            if not requeue:
+                logger.exception(
+                    "Write-behind flush of %d actions failed; dropped",
+                    len(batch))
+                return 0
+
+            logger.exception(
+                "Write-behind flush of %d actions failed; requeued", len(batch))
+
+            with self._lock:
+                self._pending = {**batch, **self._pending}
+
+            return 0
+
+        if self.on_flush and changed_user_ids:
+            self.on_flush(*changed_user_ids)
+
+        return len(batch)
+
+    def _write(self, batch):
+        """Apply `batch` ({(kind, user, target): present}) in the current
+        session; return the ids of users whose rows changed."""
+
+        changed = set()
+
+        for kind, model in MODELS.items():
+            adds = [(user, target) for (k, user, target), present
+                    in batch.items() if k == kind and present]
+            removes = [(user, target) for (k, user, target), present
+                       in batch.items() if k == kind and not present]
+
+            # a target deleted since the click would fail the whole insert
+            adds = _existing_targets(kind, adds)
+
+            for user, target in model.add_many(adds) + model.remove_many(removes):
+                changed.add(user)
+
+                if kind == FOLLOW:
+                    changed.add(target)
+
+        return changed
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def _existing_targets(kind, pairs):
+    """The (user, target) `pairs` whose user and target still exist."""
+
+    if not pairs:
+        return pairs
+
+    target_model = Message if kind == LIKE else User
+    user_ids = {user for user, _ in pairs}
+    target_ids = {target for _, target in pairs}
+
+    live_users = set(db.session.scalars(
+        db.select(User.id).where(User.id.in_(user_ids))))
+    live_targets = set(db.session.scalars(
+        db.select(target_model.id).where(target_model.id.in_(target_ids))))
+
+    return [(user, target) for user, target in pairs
+            if user in live_users and target in live_targets]
+
+
+write_behind = WriteBehindQueue()